@@ -4,25 +4,38 @@ import sys
 import os
 import argparse
 import time
-import csv
 import orjson
 from dateutil.parser import parse as dateparse
 import signal
 import random
 import sqlite3
 import gzip
-import io
 import hashlib
+import mmap
+import bisect
+import functools
+import heapq
+import math
 
 import multiprocessing
 from queue import Empty, Full
 
+from openc_common import cache_hit_rates, cache_stat_updates, column_plan, input_file_list, open_csv_file, parallel_batch_reader, record_hasher, record_tracer, xxhash
+
+# the finished child database is read through a memory map so the processes share the os page cache rather than each warming their own
+child_mmap_size = 1 << 40 # sqlite caps this at its compiled in maximum
+child_cache_size = -1024 # in kib, per process
+
+# a stratified sample keeps at least a jurisdiction's share of its rows (rounded up) up to this many, past it the hash alone is close enough
+stratify_min_rows = 1000
+
 class IOQueueProcessor():
 
     def __init__(self, input_class, output_class, **kwargs):
 
         self.process_count = kwargs.get('process_count', multiprocessing.cpu_count())
         self.all_stop = multiprocessing.Value('i', 0)
+        self.output_stop = multiprocessing.Value('i', 0)
 
         self.input_class = input_class
         self.output_class = output_class
@@ -61,6 +74,15 @@ class IOQueueProcessor():
         with self.all_stop.get_lock():
             self.all_stop.value = 1
 
+        # the output process runs on until the input processes have sent their closing stats
+        start = time.time()
+        while time.time() - start <= 15:
+            if not any(process.is_alive() for process in self.process_list[1:]):
+                break
+            time.sleep(1)
+        with self.output_stop.get_lock():
+            self.output_stop.value = 1
+
         start = time.time()
         while time.time() - start <= 15:
             if not any(process.is_alive() for process in self.process_list):
@@ -104,19 +126,23 @@ class IOQueueProcessor():
                 if result:
                     self.queue_write(output_queue, result)
 
-        input_class.close()
+        result = input_class.close()
+        if result:
+            self.queue_write(output_queue, result)
 
     def output_queue_reader(self, process_number, output_queue, function_ref, **kwargs):
 
         kwargs['process_number'] = process_number
         output_class = function_ref(**kwargs)
 
-        while self.all_stop.value == 0:
+        while True:
             queue_data = self.queue_read(output_queue)
             if queue_data:
                 with self.output_queue_read_cnt.get_lock():
                     self.output_queue_read_cnt.value += 1
                 output_class.run(queue_data)
+            elif self.output_stop.value:
+                break
 
         output_class.close()
 
@@ -162,6 +188,9 @@ class writer():
         self.output_file_handle.close()
         print(f"process {self.process_number} closed {self.output_file_name}")
 
+        for cache_name, (hit_rate, lookup_count) in cache_hit_rates(self.stat_pack).items():
+            print(f"{cache_name.lower().replace('_', ' ')} cache hit rate {hit_rate:.1%} of {lookup_count:,} lookups")
+
         # write statistics file
         if self.log_file:
             with open(self.log_file, 'w') as outfile:
@@ -179,7 +208,7 @@ class writer():
             with open('dup_hashes.csv','w') as outfile:
                 for record_hash in self.record_cache:
                     if self.record_cache[record_hash]['cnt'] > 1:
-                        print(f"{record_hash} | {self.record_cache[record_hash]['cnt']}", file=outfile)
+                        print(f"{record_hash.hex()} | {self.record_cache[record_hash]['cnt']}", file=outfile)
                         if self.record_cache[record_hash]['cnt'] >= 1000:
                             dupes_1000_cnt += 1
                         elif self.record_cache[record_hash]['cnt'] >= 100:
@@ -190,7 +219,7 @@ class writer():
                             dupes_small += 1
                         if self.record_cache[record_hash]['cnt'] > largest_dupe_cnt:
                             largest_dupe_cnt = self.record_cache[record_hash]['cnt']
-                            largest_dupe_hash = record_hash
+                            largest_dupe_hash = record_hash.hex()
             print('duplicate hashes written to dup_hashes.csv')
             print(f' hashes >= 1000     {dupes_1000_cnt}')
             print(f' hashes >= 100      {dupes_100_cnt}')
@@ -204,7 +233,9 @@ class writer():
         record_id, record_hash, json_data, payload_data, relationship_list, stat_update_list = mapped_data
 
         for stat_data in stat_update_list:
-            self.update_stat(stat_data[0], stat_data[1], stat_data[2])
+            self.update_stat(*stat_data)
+        if record_id is None: # a mapper's closing stats
+            return
 
         new_json_data = {'DATA_SOURCE': json_data['DATA_SOURCE']}
         new_json_data['RECORD_ID'] = record_id
@@ -243,14 +274,14 @@ class writer():
             self.batch_records = []
 
 
-    def update_stat(self, cat1, cat2, example=None):
+    def update_stat(self, cat1, cat2, example=None, count=1):
         if cat1 not in self.stat_pack:
             self.stat_pack[cat1] = {}
         if cat2 not in self.stat_pack[cat1]:
             self.stat_pack[cat1][cat2] = {}
             self.stat_pack[cat1][cat2]['count'] = 0
 
-        self.stat_pack[cat1][cat2]['count'] += 1
+        self.stat_pack[cat1][cat2]['count'] += count
         if example:
             if 'examples' not in self.stat_pack[cat1][cat2]:
                 self.stat_pack[cat1][cat2]['examples'] = []
@@ -273,6 +304,395 @@ class writer():
                     for key2 in subrecord:
                         self.update_stat(data_source, key2, subrecord[key2])
 
+class child_store():
+    ''' a child table written by openc-load-childb.py -m, looked up in the memory mapped files shared by all the processes '''
+
+    def __init__(self, index_file_name, data_file_name, column_list, key_count):
+        self.field_list = [column_name.upper() for column_name in column_list]
+        self.key_count = key_count
+        self.index_map = self.data_map = None
+        if not key_count:
+            return
+        with open(index_file_name, 'rb') as index_file_handle:
+            self.index_map = mmap.mmap(index_file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(data_file_name, 'rb') as data_file_handle:
+            self.data_map = mmap.mmap(data_file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_view = memoryview(self.index_map).cast('Q')
+        self.hashes = self.index_view[:key_count]
+        self.offsets = self.index_view[key_count:]
+
+    def close(self):
+        if self.index_map:
+            self.hashes.release()
+            self.offsets.release()
+            self.index_view.release()
+            self.index_map.close()
+            self.data_map.close()
+
+    def lookup(self, company_number, jurisdiction_code, limit=None):
+        if not self.key_count:
+            return []
+        hash_value = key_hash(company_number, jurisdiction_code)
+        i = bisect.bisect_left(self.hashes, hash_value)
+        while i < self.key_count and self.hashes[i] == hash_value:
+            start, end = self.offsets[i], self.offsets[i + 1]
+            header_end = self.data_map.find(b'\n', start, end)
+            if header_end < 0: # a store built before the rows had a line each
+                key_company_number, key_jurisdiction_code, row_list = orjson.loads(self.data_map[start:end])
+            else:
+                key_company_number, key_jurisdiction_code, row_count = orjson.loads(self.data_map[start:header_end])
+            if key_company_number == company_number and key_jurisdiction_code == jurisdiction_code:
+                if header_end >= 0:
+                    row_list = self.read_rows(header_end + 1, end, row_count if limit is None else min(limit, row_count))
+                else:
+                    row_list = row_list[:limit]
+                return [dict(zip(self.field_list, [company_number, jurisdiction_code] + row)) for row in row_list]
+            i += 1
+        return []
+
+    def read_rows(self, start, end, row_count):
+        ''' only the lines of the rows kept are parsed '''
+        row_list = []
+        for _ in range(row_count):
+            line_end = self.data_map.find(b'\n', start, end)
+            row_list.append(orjson.loads(self.data_map[start:line_end]))
+            start = line_end + 1
+        return row_list
+
+
+class key_filter():
+    ''' a child table's bloom filter, a company that is not in it has no rows in the table '''
+
+    def __init__(self, bit_count, hash_count, bits):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits
+
+    def might_contain(self, company_number, jurisdiction_code):
+        for position in bloom_positions(company_number, jurisdiction_code, self.bit_count, self.hash_count):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+# columnName: company_number
+# 100.0 populated, 97.42 unique
+#      1 (9)
+#      10 (7)
+#      3 (6)
+#      100 (5)
+#      11 (5)
+
+# columnName: jurisdiction_code
+# 100.0 populated, 0.5 unique
+#      us_tx (200)
+#      us_nd (200)
+#      us_tn (200)
+#      br (200)
+#      pl (200)
+
+# the columns mapper.run reads itself, unpacked in this order
+company_source_columns = ['company_number', 'jurisdiction_code', 'name', 'normalised_name', 'current_alternative_legal_name', 'previous_names',
+                          'registered_address.street_address', 'registered_address.locality', 'registered_address.region',
+                          'registered_address.postal_code', 'registered_address.country', 'registered_address.in_full',
+                          'home_jurisdiction_code', 'home_jurisdiction_company_number']
+
+# the columns mapped straight to an attribute, in output order: (column, attribute, transform, json or payload)
+company_column_mappings = [
+    # columnName: name
+    # 100.0 populated, 99.63 unique
+    #      GRUPO RHJ DE LA LAGUNA S.A. DE C.V. (4)
+    #      A & C, INC. (3)
+    #      Public Consulting Group Holdings, Inc. (3)
+    #      1 800 TOW TRUCK, INC. (3)
+    #      NEW VALLEY CORPORATION (3)
+    ('name', 'PRIMARY_NAME_ORG', 'primary_name', 'json'), # all additional names go into the other names list for de-dupe and standardization
+    # columnName: incorporation_date
+    # 73.88 populated, 37.47 unique
+    #      2021-02-26 (924)
+    #      2021-02-25 (612)
+    #      2021-02-18 (279)
+    #      2021-02-24 (213)
+    #      2021-02-22 (200)
+    ('incorporation_date', 'REGISTRATION_DATE', None, 'json'),
+    # columnName: company_type
+    # 86.82 populated, 2.97 unique
+    #      Domestic Limited Liability Company (1078)
+    #      Limited Liability Company (919)
+    #      DOMESTIC LIMITED LIABILITY COMPANY (433)
+    #      Corporation (386)
+    #      Domestic Profit Corporation (296)
+    ('company_type', 'company_type', None, 'payload'),
+    # columnName: nonprofit
+    # 100.0 populated, 0.01 unique
+    #      false (25125)
+    #      true (1075)
+    ('nonprofit', 'nonprofit', 'yes_flag', 'payload'),
+    # columnName: current_status
+    # 73.93 populated, 1.77 unique
+    #      Active (5062)
+    #      Good Standing (1118)
+    #      Registered (1093)
+    #      Dissolved (920)
+    #      Inactive (667)
+    ('current_status', 'current_status', None, 'payload'),
+    # columnName: dissolution_date
+    # 12.69 populated, 66.55 unique
+    #      2031-02-27 (90)
+    #      2022-07-15 (81)
+    #      2021-03-01 (35)
+    #      1969-12-31 (23)
+    #      2022-07-30 (22)
+    ('dissolution_date', 'dissolution_date', None, 'payload'),
+    # columnName: branch
+    # 6.85 populated, 0.11 unique
+    #      F (1771)
+    #      L (24)
+    ('branch', 'branch', None, 'payload'),
+    # columnName: business_number
+    # 0.76 populated, 100.0 unique
+    #      42007284273 (1)
+    #      53053806241 (1)
+    #      95056184206 (1)
+    #      78057121230 (1)
+    #      23057161574 (1)
+    ('business_number', 'business_number', None, 'payload'),
+    # columnName: current_alternative_legal_name_language
+    # 4.02 populated, 0.67 unique
+    #      en (349)
+    #      my (199)
+    #      km (189)
+    #      zh (168)
+    #      fr (102)
+    ('current_alternative_legal_name_language', 'current_alternative_legal_name_language', None, 'payload'),
+    # columnName: home_jurisdiction_text
+    # 14.09 populated, 8.72 unique
+    #      FL (207)
+    #      NV (197)
+    #      KS (179)
+    #      IRELAND (175)
+    #      New Mexico (161)
+    ('home_jurisdiction_text', 'home_jurisdiction_text', None, 'payload'),
+    # columnName: native_company_number
+    # 8.74 populated, 94.36 unique
+    #      1 (34)
+    #      2 (26)
+    #      4 (17)
+    #      3 (15)
+    #      5 (15)
+    ('native_company_number', 'native_company_number', None, 'payload'),
+    # columnName: retrieved_at
+    # 100.0 populated, 73.84 unique
+    #      2018-08-02 18:30:00 UTC (200)
+    #      2021-02-05 00:00:00 UTC (200)
+    #      2020-11-22 18:30:00 UTC (200)
+    #      2021-02-26 00:00:00 UTC (199)
+    #      2020-12-13 00:00:00 UTC (198)
+    ('retrieved_at', 'retrieved_at', None, 'payload'),
+    # columnName: registry_url
+    # 58.44 populated, 96.5 unique
+    #      http://dati.ur.gov.lv/ (200)
+    #      https://data.brreg.no/enhetsregisteret/api/enheter/lastned (103)
+    #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl02$lnkCrBr','') (61)
+    #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl03$lnkCrBr','') (52)
+    #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl04$lnkCrBr','') (41)
+    ('registry_url', 'registry_url', None, 'payload'),
+    # columnName: restricted_for_marketing
+    # 0.93 populated, 0.41 unique
+    #      true (244)
+    ('restricted_for_marketing', 'restricted_for_marketing', 'yes_flag', 'payload'),
+    # columnName: inactive
+    # 75.51 populated, 0.01 unique
+    #      false (13688)
+    #      true (6096)
+    ('inactive', 'inactive', 'yes_flag', 'payload'),
+    # columnName: accounts_next_due
+    # 0.47 populated, 13.82 unique
+    #      2022-12-01 (100)
+    #      2005-01-31 (3)
+    #      2021-07-31 (3)
+    #      2021-12-31 (2)
+    #      2021-09-30 (2)
+    ('accounts_next_due', 'accounts_next_due', None, 'payload'),
+    # columnName: accounts_reference_date
+    # 0.76 populated, 13.0 unique
+    #      03-31 (116)
+    #      31-01 (9)
+    #      30-04 (8)
+    #      31-12 (8)
+    #      30-06 (6)
+    ('accounts_reference_date', 'accounts_reference_date', None, 'payload'),
+    # columnName: accounts_last_made_up_date
+    # 0.29 populated, 76.32 unique
+    #      2003-03-31 (3)
+    #      2007-12-31 (3)
+    #      2008-01-31 (3)
+    #      2017-03-31 (3)
+    #      2019-08-31 (2)
+    ('accounts_last_made_up_date', 'accounts_last_made_up_date', None, 'payload'),
+    # columnName: annual_return_next_due
+    # 0.77 populated, 41.79 unique
+    #      2021-06-10 (100)
+    #      2020-09-30 (8)
+    #      2021-09-30 (7)
+    #      2015-09-30 (3)
+    #      2020-12-31 (2)
+    ('annual_return_next_due', 'annual_return_next_due', None, 'payload'),
+    # columnName: annual_return_last_made_up_date
+    # 0.73 populated, 90.0 unique
+    #      2019-09-30 (5)
+    #      2020-09-30 (3)
+    #      2014-09-30 (3)
+    #      2004-02-18 (2)
+    #      2007-04-26 (2)
+    ('annual_return_last_made_up_date', 'annual_return_last_made_up_date', None, 'payload'),
+    # columnName: has_been_liquidated
+    # 0.18 populated, 4.35 unique
+    #      false (38)
+    #      true (8)
+    ('has_been_liquidated', 'has_been_liquidated', 'yes_flag', 'payload'),
+    # columnName: has_insolvency_history
+    # 0.53 populated, 1.43 unique
+    #      false (129)
+    #      true (11)
+    ('has_insolvency_history', 'has_insolvency_history', 'yes_flag', 'payload'),
+    # columnName: has_charges
+    # 0.52 populated, 1.46 unique
+    #      false (131)
+    #      true (6)
+    ('has_charges', 'has_charges', 'yes_flag', 'payload'),
+    # columnName: number of employees
+    ('number_of_employees', 'number_of_employees', None, 'payload'),
+    # columnName: home_jurisdiction_code
+    # 3.83 populated, 5.88 unique
+    #      us_de (248)
+    #      us_ny (57)
+    #      us_ca (56)
+    #      us_fl (49)
+    #      us_tx (43)
+    ('home_jurisdiction_code', 'home_jurisdiction_code', None, 'payload'),
+    # columnName: home_jurisdiction_company_number
+    # 3.83 populated, 96.71 unique
+    #      2021-000973162 (3)
+    #      802380338 (3)
+    #      0100743157 (3)
+    #      9860 (3)
+    #      112 (3)
+    ('home_jurisdiction_company_number', 'home_jurisdiction_company_number', None, 'payload'),
+    # columnName: industry_code_uids
+    # 6.86 populated, 56.9 unique
+    #      gl_gb_2000-050105 (57)
+    #      us_naics_2007-9999 (44)
+    #      me_kd_2010-4719|eu_nace_2-4719|isic_4-4719|eu_nace_2-471|eu_nace_2-47|eu_nace_2-G|isic_4-471|isic_4-47|isic_4-G (40)
+    #      th_tsic_2009-41002|isic_4-4100|isic_4-410|isic_4-41|isic_4-F (31)
+    #      gl_gb_2000-050100 (27)
+    ('industry_code_uids', 'industry_code_uids', None, 'payload'),
+    # columnName: latest_accounts_date
+    # 0.58 populated, 20.53 unique
+    #      2020-12-31 (43)
+    #      2014-12-31 (31)
+    #      2020-09-30 (20)
+    #      2016-12-31 (8)
+    #      2015-12-31 (5)
+    ('latest_accounts_date', 'latest_accounts_date', None, 'payload'),
+    # columnName: latest_accounts_cash
+    # 0.02 populated, 100.0 unique
+    #      1425 (1)
+    #      65 (1)
+    #      50793 (1)
+    #      549111 (1)
+    ('latest_accounts_cash', 'latest_accounts_cash', None, 'payload'),
+    # columnName: latest_accounts_assets
+    # 0.49 populated, 89.92 unique
+    #      0 (4)
+    #      2376195 (4)
+    #      550 (3)
+    #      1000 (2)
+    #      82485 (2)
+    ('latest_accounts_assets', 'latest_accounts_assets', None, 'payload'),
+    # columnName: latest_accounts_liabilities
+    # 0.02 populated, 100.0 unique
+    #      582551 (1)
+    #      689639 (1)
+    #      7930 (1)
+    #      662 (1)
+    #      897482 (1)
+    ('latest_accounts_liabilities', 'latest_accounts_liabilities', None, 'payload')]
+
+# the low cardinality columns, cleaned through the mapper's cache
+company_cached_columns = ['jurisdiction_code', 'registered_address.locality', 'registered_address.region', 'registered_address.postal_code',
+                          'registered_address.country', 'home_jurisdiction_code', 'incorporation_date', 'company_type', 'nonprofit', 'current_status',
+                          'dissolution_date', 'branch', 'current_alternative_legal_name_language', 'home_jurisdiction_text', 'retrieved_at',
+                          'restricted_for_marketing', 'inactive', 'accounts_next_due', 'accounts_reference_date', 'accounts_last_made_up_date',
+                          'annual_return_next_due', 'annual_return_last_made_up_date', 'has_been_liquidated', 'has_insolvency_history', 'has_charges',
+                          'number_of_employees', 'industry_code_uids', 'latest_accounts_date']
+
+company_column_transforms = {
+    'primary_name': lambda value: value[0:250].upper(),
+    'yes_flag': lambda value: 'Yes' if value.upper() == 'TRUE' else ''}
+
+# the optional features and payload chosen with -g: (columns, child tables), the company number, jurisdiction, name and registration date are always mapped
+company_feature_groups = {
+    'names': (['normalised_name', 'current_alternative_legal_name', 'previous_names'], ['alias']),
+    'addresses': (['registered_address.street_address', 'registered_address.locality', 'registered_address.region',
+                   'registered_address.postal_code', 'registered_address.country', 'registered_address.in_full'], ['address']),
+    'identifiers': ([], ['identifier']),
+    'phones': ([], ['telephone']),
+    'websites': ([], ['website']),
+    'branches': (['home_jurisdiction_code', 'home_jurisdiction_company_number'], []),
+    'status': (['company_type', 'nonprofit', 'current_status', 'dissolution_date', 'branch', 'inactive'], []),
+    'registry': (['business_number', 'current_alternative_legal_name_language', 'home_jurisdiction_text', 'native_company_number',
+                  'retrieved_at', 'registry_url', 'restricted_for_marketing'], []),
+    'filings': (['accounts_next_due', 'accounts_reference_date', 'accounts_last_made_up_date', 'annual_return_next_due',
+                 'annual_return_last_made_up_date'], []),
+    'financials': (['number_of_employees', 'latest_accounts_date', 'latest_accounts_cash', 'latest_accounts_assets', 'latest_accounts_liabilities'], []),
+    'insolvency': (['has_been_liquidated', 'has_insolvency_history', 'has_charges'], []),
+    'industry': (['industry_code_uids'], [])}
+
+
+class row_sampler():
+    ''' keeps a reproducible fraction of the companies by the hash of their key, a row is kept if its hash is under its jurisdiction's threshold '''
+
+    def __init__(self, header_list, fraction):
+        self.key_positions = [(header.index('company_number') if 'company_number' in header else sys.maxsize,
+                               header.index('jurisdiction_code') if 'jurisdiction_code' in header else sys.maxsize) for header in header_list]
+        self.fraction = fraction
+        self.threshold = fraction * (1 << 63) # key_hash is 63 bits
+        self.thresholds = {}
+
+    def row_key(self, file_number, raw_row):
+        company_number_position, jurisdiction_code_position = self.key_positions[file_number]
+        company_number = clean_value(raw_row[company_number_position]) if company_number_position < len(raw_row) else ''
+        jurisdiction_code = clean_value(raw_row[jurisdiction_code_position]) if jurisdiction_code_position < len(raw_row) else ''
+        return key_hash(company_number, jurisdiction_code), jurisdiction_code
+
+    def stratify(self, file_list):
+        ''' a first pass over the files raises each jurisdiction's threshold so the hash keeps at least its share of the rows
+
+            the threshold only depends on the jurisdiction's keys, so the sample does not depend on the order of the rows and a
+            smaller sample is still part of a larger one '''
+        row_counts = {}
+        lowest_hashes = {} # a max heap of each jurisdiction's lowest hashes, negated
+        for file_number, row_list in parallel_batch_reader(file_list, 10000):
+            for input_row in row_list:
+                hash_value, jurisdiction_code = self.row_key(file_number, input_row)
+                row_counts[jurisdiction_code] = row_counts.get(jurisdiction_code, 0) + 1
+                hash_heap = lowest_hashes.setdefault(jurisdiction_code, [])
+                if len(hash_heap) < stratify_min_rows:
+                    heapq.heappush(hash_heap, -hash_value)
+                elif -hash_heap[0] > hash_value:
+                    heapq.heapreplace(hash_heap, -hash_value)
+        for jurisdiction_code, row_count in row_counts.items():
+            # the hash of the share'th lowest row is the least threshold that keeps the share
+            share_count = min(math.ceil(row_count * self.fraction), stratify_min_rows)
+            share_hash = sorted(-x for x in lowest_hashes[jurisdiction_code])[share_count - 1]
+            self.thresholds[jurisdiction_code] = max(self.threshold, share_hash + 1)
+
+    def keep(self, file_number, raw_row):
+        hash_value, jurisdiction_code = self.row_key(file_number, raw_row)
+        return hash_value < self.thresholds.get(jurisdiction_code, self.threshold)
+
+
 class mapper():
 
     def __init__(self, **kwargs):
@@ -280,21 +700,132 @@ class mapper():
         self.data_source = kwargs['data_source']
         self.child_table_list = kwargs['child_table_list']
         self.child_database_name = kwargs['child_database_name']
-        self.dbo = sqlite3.connect(f'file:{self.child_database_name}?mode=ro', uri=True)
-        print(f"process {self.process_number} opened {self.child_database_name}")
+        self.max_child_rows = kwargs.get('max_child_rows')
+        self.record_hasher = record_hasher(kwargs.get('hash_algorithm', 'blake2b')) if kwargs.get('log_duplicates') else None
+        # the repeated values are cleaned and normalized through bounded lru caches, a size of 0 turns them off
+        self.caches = {}
+        self.cache_counts = {}
+        if kwargs.get('cache_size', 100000):
+            self.caches['CLEAN'] = functools.lru_cache(maxsize=kwargs.get('cache_size', 100000))(clean_value)
+            self.caches['ADDRESS'] = functools.lru_cache(maxsize=kwargs.get('cache_size', 100000))(normalize_address_value)
+        self.address_value = self.caches.get('ADDRESS', normalize_address_value)
+        self.tracer = record_tracer(f'process {self.process_number}', kwargs['slow_threshold']) if kwargs.get('slow_threshold') is not None else None
+        # a plan per input file as the parts may not share a header
+        self.column_plans = [column_plan(header, company_source_columns, company_column_mappings, company_column_transforms, clean_value, kwargs.get('excluded_columns', set()),
+                                         company_cached_columns, self.caches.get('CLEAN')) for header in kwargs['header_list']]
+        self.child_stores = {}
+        self.child_filters = {}
+        self.shard_files = {}
+        self.shard_dbos = {}
+        self.jurisdiction_codes = None
+        self.decoded_columns = {}
+        self.child_database_stamp = kwargs['child_database_stamp']
+        self.child_database_changed = kwargs['child_database_changed']
+        self.dbo = open_child_database(self.child_database_name)
+        self.check_child_database(self.dbo)
+        if 'child_codes' in self.child_table_list:
+            for column_name, code, value in self.dbo.cursor().execute('select column_name, code, value from child_codes').fetchall():
+                self.decoded_columns.setdefault(column_name.upper(), {})[code] = value
+            self.jurisdiction_codes = {value: code for code, value in self.decoded_columns.get('JURISDICTION_CODE', {}).items()}
+        if 'shards' in self.child_table_list:
+            for shard_by, shard_count, shard_key, file_name in self.dbo.cursor().execute('select shard_by, shard_count, shard_key, file_name from shards').fetchall():
+                self.shard_by, self.shard_count = shard_by, shard_count
+                self.shard_files[shard_key] = os.path.join(os.path.dirname(self.child_database_name), file_name)
+        if 'bloom_filter' in self.child_table_list:
+            for table_name, bit_count, hash_count, bits in self.dbo.cursor().execute('select table_name, bit_count, hash_count, bits from bloom_filter').fetchall():
+                self.child_filters[table_name] = key_filter(bit_count, hash_count, bits)
+        if 'mmap_store' in self.child_table_list:
+            for table_name, column_list, key_count in self.dbo.cursor().execute('select table_name, column_list, key_count from mmap_store').fetchall():
+                index_file_name, data_file_name = f'{self.child_database_name}.{table_name}.idx', f'{self.child_database_name}.{table_name}.dat'
+                self.child_stores[table_name] = child_store(index_file_name, data_file_name, column_list.split(','), key_count)
+            self.dbo.close()
+            self.dbo = None
+            print(f"process {self.process_number} opened the {self.child_database_name} memory mapped store")
+        elif self.shard_files:
+            print(f"process {self.process_number} opened {self.child_database_name} with {len(self.shard_files)} shards")
+        else:
+            print(f"process {self.process_number} opened {self.child_database_name}")
 
     def close(self):
-        self.dbo.close()
+        for store in self.child_stores.values():
+            store.close()
+        for shard_dbo in self.shard_dbos.values():
+            shard_dbo.close()
+        if self.dbo:
+            self.dbo.close()
         print(f"process {self.process_number} closed {self.child_database_name}")
-
-    def run(self, raw_data):
+        # the cache hits and misses go to the writer to be summed across the processes
+        return None, None, None, None, None, cache_stat_updates(self.caches, self.cache_counts)
+
+    def check_child_database(self, dbo=None):
+        ''' an immutable read of a database that has changed is silently wrong, so the run is marked invalid '''
+        if child_database_stamp(self.child_database_name) == self.child_database_stamp and \
+           (dbo is None or dbo.cursor().execute("select 1 from sqlite_master where type='table' and name='finished'").fetchone()):
+            return True
+        print(f"process {self.process_number} found {self.child_database_name} changed or not finished since the run started")
+        with self.child_database_changed.get_lock():
+            self.child_database_changed.value = 1
+        return False
+
+    def child_rows(self, table_name, company_number, jurisdiction_code, record_id, stat_update_list):
+        ''' returns a company's rows from a child table as dicts keyed by upper case column name, up to the cap if there is one '''
+        # one more than the cap is fetched to tell a capped company from one with exactly that many rows
+        limit = self.max_child_rows + 1 if self.max_child_rows is not None else None
+        row_list = self.fetch_child_rows(table_name, company_number, jurisdiction_code, limit)
+        if self.tracer:
+            self.tracer.rows(table_name, len(row_list))
+        if limit and len(row_list) > self.max_child_rows:
+            stat_update_list.append(['_FYI', f'{table_name.upper()}_ROWS_CAPPED', record_id])
+            del row_list[self.max_child_rows:]
+        return row_list
+
+    def fetch_child_rows(self, table_name, company_number, jurisdiction_code, limit):
+        # an encoded database is looked up by the jurisdiction's code, the shard is still chosen by its value
+        key_jurisdiction_code = jurisdiction_code
+        if self.jurisdiction_codes is not None:
+            key_jurisdiction_code = self.jurisdiction_codes.get(jurisdiction_code)
+            if key_jurisdiction_code is None:
+                return []
+        if table_name in self.child_filters and not self.child_filters[table_name].might_contain(company_number, key_jurisdiction_code):
+            return []
+        if table_name in self.child_stores:
+            return self.decode_rows(self.child_stores[table_name].lookup(company_number, key_jurisdiction_code, limit))
+        dbo = self.shard_connection(company_number, jurisdiction_code) if self.shard_files else self.dbo
+        if not dbo:
+            return []
+        sql = f'select * from {table_name} where company_number = ? and jurisdiction_code = ? limit ?'
+        return self.decode_rows(sql_fetch_all(sql_exec(dbo, sql, [company_number, key_jurisdiction_code, limit if limit is not None else -1])))
+
+    def decode_rows(self, row_list):
+        for row in row_list:
+            for column_name in self.decoded_columns:
+                if row.get(column_name) is not None:
+                    row[column_name] = self.decoded_columns[column_name][row[column_name]]
+        return row_list
+
+    def shard_connection(self, company_number, jurisdiction_code):
+        ''' the shards are opened the first time they are needed, there is none for a jurisdiction without child rows '''
+        key = shard_key(self.shard_by, self.shard_count, company_number, jurisdiction_code)
+        if key not in self.shard_dbos and key in self.shard_files:
+            self.shard_dbos[key] = open_child_database(self.shard_files[key])
+            self.check_child_database()
+        return self.shard_dbos.get(key)
+
+    def run(self, input_data):
         json_data = {}
         payload_data = {}
         stat_update_list = []
-
-        #--clean values
-        for attribute in raw_data:
-            raw_data[attribute] = clean_value(raw_data[attribute])
+        tracer = self.tracer
+        if tracer:
+            tracer.start()
+
+        #--clean values, the columns read here come first
+        file_number, raw_row = input_data
+        plan = self.column_plans[file_number]
+        values = plan.read(raw_row)
+        company_number, jurisdiction_code, name, normalised_name, current_alternative_legal_name, previous_names, \
+            street_address, locality, region, postal_code, country, in_full, \
+            home_jurisdiction_code, home_jurisdiction_company_number = values[0:plan.source_count]
 
         #--place any filters needed here
 
@@ -309,35 +840,10 @@ class mapper():
         json_data['RECORD_TYPE'] = 'ORGANIZATION'
 
         #--the record_id should be unique, remove this mapping if there is not one
-        record_id = raw_data['company_number'] + '-' + raw_data['jurisdiction_code']
-
-        #--column mappings
-        # columnName: company_number
-        # 100.0 populated, 97.42 unique
-        #      1 (9)
-        #      10 (7)
-        #      3 (6)
-        #      100 (5)
-        #      11 (5)
-        #json_data['company_number'] = raw_data['company_number']
-
-        # columnName: jurisdiction_code
-        # 100.0 populated, 0.5 unique
-        #      us_tx (200)
-        #      us_nd (200)
-        #      us_tn (200)
-        #      br (200)
-        #      pl (200)
-        #json_data['jurisdiction_code'] = raw_data['jurisdiction_code']
-
-        # columnName: name
-        # 100.0 populated, 99.63 unique
-        #      GRUPO RHJ DE LA LAGUNA S.A. DE C.V. (4)
-        #      A & C, INC. (3)
-        #      Public Consulting Group Holdings, Inc. (3)
-        #      1 800 TOW TRUCK, INC. (3)
-        #      NEW VALLEY CORPORATION (3)
-        json_data['PRIMARY_NAME_ORG'] = raw_data['name'][0:250].upper()  # note that all additional names will go into the other names list array for de-dupe and standardization
+        record_id = company_number + '-' + jurisdiction_code
+
+        #--the straight column mappings
+        plan.apply(values, json_data, payload_data)
 
         # columnName: normalised_name
         # 100.0 populated, 99.38 unique
@@ -346,65 +852,8 @@ class mapper():
         #      a and c incorporated (3)
         #      shiftpixy staffing incorporated (3)
         #      1 800 tow truck incorporated (3)
-        if raw_data['normalised_name']:
-            other_names_list = [{'NAME_TYPE': 'NORMALIZED', 'NAME_ORG': raw_data['normalised_name']}]
-
-        # columnName: company_type
-        # 86.82 populated, 2.97 unique
-        #      Domestic Limited Liability Company (1078)
-        #      Limited Liability Company (919)
-        #      DOMESTIC LIMITED LIABILITY COMPANY (433)
-        #      Corporation (386)
-        #      Domestic Profit Corporation (296)
-        payload_data['company_type'] = raw_data['company_type']
-
-        # columnName: nonprofit
-        # 100.0 populated, 0.01 unique
-        #      false (25125)
-        #      true (1075)
-        payload_data['nonprofit'] = 'Yes' if raw_data['nonprofit'].upper() == 'TRUE' else ''
-
-        # columnName: current_status
-        # 73.93 populated, 1.77 unique
-        #      Active (5062)
-        #      Good Standing (1118)
-        #      Registered (1093)
-        #      Dissolved (920)
-        #      Inactive (667)
-        payload_data['current_status'] = raw_data['current_status']
-
-        # columnName: incorporation_date
-        # 73.88 populated, 37.47 unique
-        #      2021-02-26 (924)
-        #      2021-02-25 (612)
-        #      2021-02-18 (279)
-        #      2021-02-24 (213)
-        #      2021-02-22 (200)
-        json_data['REGISTRATION_DATE'] = raw_data['incorporation_date']
-
-        # columnName: dissolution_date
-        # 12.69 populated, 66.55 unique
-        #      2031-02-27 (90)
-        #      2022-07-15 (81)
-        #      2021-03-01 (35)
-        #      1969-12-31 (23)
-        #      2022-07-30 (22)
-        payload_data['dissolution_date'] = raw_data['dissolution_date']
-
-        # columnName: branch
-        # 6.85 populated, 0.11 unique
-        #      F (1771)
-        #      L (24)
-        payload_data['branch'] = raw_data['branch']
-
-        # columnName: business_number
-        # 0.76 populated, 100.0 unique
-        #      42007284273 (1)
-        #      53053806241 (1)
-        #      95056184206 (1)
-        #      78057121230 (1)
-        #      23057161574 (1)
-        payload_data['business_number'] = raw_data['business_number']
+        if normalised_name:
+            other_names_list = [{'NAME_TYPE': 'NORMALIZED', 'NAME_ORG': normalised_name}]
 
         # columnName: current_alternative_legal_name
         # 4.16 populated, 99.73 unique
@@ -413,35 +862,8 @@ class mapper():
         #      လမ်းသစ်ဆန်းကုမ္ပဏီလီမိတက် (2)
         #      អ៊ែតវ៉ានស៍ សឺវេ អ៉ិនស្ទ្រូម៉ិន​ ( អេអេសអាយ ) (1)
         #      ជេប៊ីអិល មេគង្គ ខូ អិលធីឌី (1)
-        if raw_data['current_alternative_legal_name']:
-            other_names_list = [{'NAME_TYPE': 'CURRENT-LEGAL', 'NAME_ORG': raw_data['current_alternative_legal_name']}]
-
-        # columnName: current_alternative_legal_name_language
-        # 4.02 populated, 0.67 unique
-        #      en (349)
-        #      my (199)
-        #      km (189)
-        #      zh (168)
-        #      fr (102)
-        payload_data['current_alternative_legal_name_language'] = raw_data['current_alternative_legal_name_language']
-
-        # columnName: home_jurisdiction_text
-        # 14.09 populated, 8.72 unique
-        #      FL (207)
-        #      NV (197)
-        #      KS (179)
-        #      IRELAND (175)
-        #      New Mexico (161)
-        payload_data['home_jurisdiction_text'] = raw_data['home_jurisdiction_text']
-
-        # columnName: native_company_number
-        # 8.74 populated, 94.36 unique
-        #      1 (34)
-        #      2 (26)
-        #      4 (17)
-        #      3 (15)
-        #      5 (15)
-        payload_data['native_company_number'] = raw_data['native_company_number']
+        if current_alternative_legal_name:
+            other_names_list = [{'NAME_TYPE': 'CURRENT-LEGAL', 'NAME_ORG': current_alternative_legal_name}]
 
         # columnName: previous_names
         # 4.33 populated, 99.47 unique
@@ -450,116 +872,19 @@ class mapper():
         #      Zurich Investments Limited (2)
         #      Zurich Enterprises Limited (2)
         #      Z ENTERPRISES, LLC (2)
-        if raw_data['previous_names']:
-            for name_org in raw_data['previous_names'].split('|'):
+        if previous_names:
+            for name_org in previous_names.split('|'):
                 if not name_org:
                     continue
                 other_names_list.append({'NAME_TYPE': 'PREVIOUS', 'NAME_ORG': name_org})
 
-        # columnName: retrieved_at
-        # 100.0 populated, 73.84 unique
-        #      2018-08-02 18:30:00 UTC (200)
-        #      2021-02-05 00:00:00 UTC (200)
-        #      2020-11-22 18:30:00 UTC (200)
-        #      2021-02-26 00:00:00 UTC (199)
-        #      2020-12-13 00:00:00 UTC (198)
-        payload_data['retrieved_at'] = raw_data['retrieved_at']
-
-        # columnName: registry_url
-        # 58.44 populated, 96.5 unique
-        #      http://dati.ur.gov.lv/ (200)
-        #      https://data.brreg.no/enhetsregisteret/api/enheter/lastned (103)
-        #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl02$lnkCrBr','') (61)
-        #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl03$lnkCrBr','') (52)
-        #      http://www.moic.gov.bh/CReServices/inquiry/javascript:__doPostBack('grdCR$ctl04$lnkCrBr','') (41)
-        payload_data['registry_url'] = raw_data['registry_url']
-
-        # columnName: restricted_for_marketing
-        # 0.93 populated, 0.41 unique
-        #      true (244)
-        payload_data['restricted_for_marketing'] = 'Yes' if raw_data['restricted_for_marketing'].upper() == 'TRUE' else ''
-
-        # columnName: inactive
-        # 75.51 populated, 0.01 unique
-        #      false (13688)
-        #      true (6096)
-        payload_data['inactive'] = 'Yes' if raw_data['inactive'].upper() == 'TRUE' else ''
-
-        # columnName: accounts_next_due
-        # 0.47 populated, 13.82 unique
-        #      2022-12-01 (100)
-        #      2005-01-31 (3)
-        #      2021-07-31 (3)
-        #      2021-12-31 (2)
-        #      2021-09-30 (2)
-        payload_data['accounts_next_due'] = raw_data['accounts_next_due']
-
-        # columnName: accounts_reference_date
-        # 0.76 populated, 13.0 unique
-        #      03-31 (116)
-        #      31-01 (9)
-        #      30-04 (8)
-        #      31-12 (8)
-        #      30-06 (6)
-        payload_data['accounts_reference_date'] = raw_data['accounts_reference_date']
-
-        # columnName: accounts_last_made_up_date
-        # 0.29 populated, 76.32 unique
-        #      2003-03-31 (3)
-        #      2007-12-31 (3)
-        #      2008-01-31 (3)
-        #      2017-03-31 (3)
-        #      2019-08-31 (2)
-        payload_data['accounts_last_made_up_date'] = raw_data['accounts_last_made_up_date']
-
-        # columnName: annual_return_next_due
-        # 0.77 populated, 41.79 unique
-        #      2021-06-10 (100)
-        #      2020-09-30 (8)
-        #      2021-09-30 (7)
-        #      2015-09-30 (3)
-        #      2020-12-31 (2)
-        payload_data['annual_return_next_due'] = raw_data['annual_return_next_due']
-
-        # columnName: annual_return_last_made_up_date
-        # 0.73 populated, 90.0 unique
-        #      2019-09-30 (5)
-        #      2020-09-30 (3)
-        #      2014-09-30 (3)
-        #      2004-02-18 (2)
-        #      2007-04-26 (2)
-        payload_data['annual_return_last_made_up_date'] = raw_data['annual_return_last_made_up_date']
-
-        # columnName: has_been_liquidated
-        # 0.18 populated, 4.35 unique
-        #      false (38)
-        #      true (8)
-        payload_data['has_been_liquidated'] = 'Yes' if raw_data['has_been_liquidated'].upper() == 'TRUE' else ''
-
-        # columnName: has_insolvency_history
-        # 0.53 populated, 1.43 unique
-        #      false (129)
-        #      true (11)
-        payload_data['has_insolvency_history'] = 'Yes' if raw_data['has_insolvency_history'].upper() == 'TRUE' else ''
-
-        # columnName: has_charges
-        # 0.52 populated, 1.46 unique
-        #      false (131)
-        #      true (6)
-        payload_data['has_charges'] = 'Yes' if raw_data['has_charges'].upper() == 'TRUE' else ''
-
-
-        # columnName: number of employees
-        payload_data['number_of_employees'] = raw_data['number_of_employees']
-
-
         # log if parsed address is different than full address if both populated
-        if raw_data['registered_address.street_address'] and raw_data['registered_address.in_full']:
-            if raw_data['registered_address.street_address'].upper() not in raw_data['registered_address.in_full'].upper():
+        if street_address and in_full:
+            if street_address.upper() not in in_full.upper():
                 stat_update_list.append(['_FYI', 'REGISTERED_ADDR1_NOT_IN_ADDR_FULL', record_id])
 
         registered_address_for_dedupe = {}
-        if raw_data['registered_address.in_full']:
+        if in_full:
             stat_update_list.append(['_FYI', 'REGISTERED_ADDR_FULL_COUNT', record_id])
 
             # columnName: registered_address.in_full
@@ -569,13 +894,12 @@ class mapper():
             #      BUITENLAND, Aruba (67)
             #      KUALA LUMPUR, WILAYAH PERSEKUTUAN, Malaysia (37)
             #      DISTRITO PANAMÁ, PROVINCIA PANAMÁ, Panama (36)
-            json_data['REGISTERED_ADDR_FULL'] = remove_line_feeds(raw_data['registered_address.in_full']).upper()
-            json_data['REGISTERED_ADDR_COUNTRY'] = remove_line_feeds(raw_data['registered_address.country']).upper()  #--can help determine address parsing rules
+            json_data['REGISTERED_ADDR_FULL'] = remove_line_feeds(in_full).upper()
+            json_data['REGISTERED_ADDR_COUNTRY'] = self.address_value(country)  #--can help determine address parsing rules
             registered_address_for_dedupe['ADDR_FULL'] = json_data['REGISTERED_ADDR_FULL']
             registered_address_for_dedupe['ADDR_COUNTRY'] = json_data['REGISTERED_ADDR_COUNTRY']
 
-        elif raw_data['registered_address.street_address'] or raw_data['registered_address.locality'] or raw_data['registered_address.region'] or \
-             raw_data['registered_address.postal_code'] or raw_data['registered_address.country']:
+        elif street_address or locality or region or postal_code or country:
             stat_update_list.append(['_FYI', 'REGISTERED_ADDR_PARSED_COUNT', record_id])
 
             # columnName: registered_address.street_address
@@ -585,7 +909,7 @@ class mapper():
             #      BUITENLAND (67)
             #      DISTRITO PANAMÁ, PROVINCIA PANAMÁ (36)
             #      NEW ORLEANS, LA 70150 (34)
-            json_data['REGISTERED_ADDR_LINE1'] = remove_line_feeds(raw_data['registered_address.street_address'].upper())
+            json_data['REGISTERED_ADDR_LINE1'] = remove_line_feeds(street_address.upper())
             registered_address_for_dedupe['ADDR_LINE1'] = json_data['REGISTERED_ADDR_LINE1']
 
             # columnName: registered_address.locality
@@ -595,7 +919,7 @@ class mapper():
             #      กรุงเทพมหานคร (78)
             #      DOUGLAS (76)
             #      St. John's (73)
-            json_data['REGISTERED_ADDR_CITY'] = remove_line_feeds(raw_data['registered_address.locality']).upper()
+            json_data['REGISTERED_ADDR_CITY'] = self.address_value(locality)
             registered_address_for_dedupe['ADDR_CITY'] = json_data['REGISTERED_ADDR_CITY']
 
             # columnName: registered_address.region
@@ -605,7 +929,7 @@ class mapper():
             #      WA (161)
             #      Virginia (143)
             #      MA (142)
-            json_data['REGISTERED_ADDR_STATE'] = remove_line_feeds(raw_data['registered_address.region']).upper()
+            json_data['REGISTERED_ADDR_STATE'] = self.address_value(region)
             registered_address_for_dedupe['ADDR_STATE'] = json_data['REGISTERED_ADDR_STATE']
 
             # columnName: registered_address.postal_code
@@ -615,7 +939,7 @@ class mapper():
             #      27615 (23)
             #      34100 (21)
             #      28210 (17)
-            json_data['REGISTERED_ADDR_POSTAL_CODE'] = remove_line_feeds(raw_data['registered_address.postal_code']).upper()
+            json_data['REGISTERED_ADDR_POSTAL_CODE'] = self.address_value(postal_code)
             registered_address_for_dedupe['ADDR_POSTAL_CODE'] = json_data['REGISTERED_ADDR_POSTAL_CODE']
 
             # columnName: registered_address.country
@@ -625,106 +949,49 @@ class mapper():
             #      USA (335)
             #      UNITED STATES (298)
             #      Ukraine (200)
-            json_data['REGISTERED_ADDR_COUNTRY'] = remove_line_feeds(raw_data['registered_address.country']).upper()
+            json_data['REGISTERED_ADDR_COUNTRY'] = self.address_value(country)
             registered_address_for_dedupe['ADDR_COUNTRY'] = json_data['REGISTERED_ADDR_COUNTRY']
 
-        # columnName: home_jurisdiction_code
-        # 3.83 populated, 5.88 unique
-        #      us_de (248)
-        #      us_ny (57)
-        #      us_ca (56)
-        #      us_fl (49)
-        #      us_tx (43)
-        payload_data['home_jurisdiction_code'] = raw_data['home_jurisdiction_code']
-
-        # columnName: home_jurisdiction_company_number
-        # 3.83 populated, 96.71 unique
-        #      2021-000973162 (3)
-        #      802380338 (3)
-        #      0100743157 (3)
-        #      9860 (3)
-        #      112 (3)
-        payload_data['home_jurisdiction_company_number'] = raw_data['home_jurisdiction_company_number']
-
-        # columnName: industry_code_uids
-        # 6.86 populated, 56.9 unique
-        #      gl_gb_2000-050105 (57)
-        #      us_naics_2007-9999 (44)
-        #      me_kd_2010-4719|eu_nace_2-4719|isic_4-4719|eu_nace_2-471|eu_nace_2-47|eu_nace_2-G|isic_4-471|isic_4-47|isic_4-G (40)
-        #      th_tsic_2009-41002|isic_4-4100|isic_4-410|isic_4-41|isic_4-F (31)
-        #      gl_gb_2000-050100 (27)
-        payload_data['industry_code_uids'] = raw_data['industry_code_uids']
-
-        # columnName: latest_accounts_date
-        # 0.58 populated, 20.53 unique
-        #      2020-12-31 (43)
-        #      2014-12-31 (31)
-        #      2020-09-30 (20)
-        #      2016-12-31 (8)
-        #      2015-12-31 (5)
-        payload_data['latest_accounts_date'] = raw_data['latest_accounts_date']
-
-        # columnName: latest_accounts_cash
-        # 0.02 populated, 100.0 unique
-        #      1425 (1)
-        #      65 (1)
-        #      50793 (1)
-        #      549111 (1)
-        payload_data['latest_accounts_cash'] = raw_data['latest_accounts_cash']
-
-        # columnName: latest_accounts_assets
-        # 0.49 populated, 89.92 unique
-        #      0 (4)
-        #      2376195 (4)
-        #      550 (3)
-        #      1000 (2)
-        #      82485 (2)
-        payload_data['latest_accounts_assets'] = raw_data['latest_accounts_assets']
-
-        # columnName: latest_accounts_liabilities
-        # 0.02 populated, 100.0 unique
-        #      582551 (1)
-        #      689639 (1)
-        #      7930 (1)
-        #      662 (1)
-        #      897482 (1)
-        payload_data['latest_accounts_liabilities'] = raw_data['latest_accounts_liabilities']
+        if tracer:
+            tracer.stage('columns')
 
         # alias name child table
         if 'alias' in self.child_table_list:
-            sql = 'select * from alias where company_number = ? and jurisdiction_code = ?'
-            for record in sql_fetch_all(sql_exec(self.dbo, sql, [raw_data['company_number'], raw_data['jurisdiction_code']])):
+            for record in self.child_rows('alias', company_number, jurisdiction_code, record_id, stat_update_list):
                 if not record['NAME']:
                     continue
                 name_type = 'ALIAS' if not record['TYPE'] else record['TYPE'].upper()
                 stat_update_list.append(['_FYI', 'NAME_TYPES', name_type])
                 other_names_list.append({'NAME_TYPE': name_type, 'NAME_ORG': record['NAME']})
+            if tracer:
+                tracer.stage('alias')
 
         #--add the accumulated other names, truncating any super long ones, and getting rid of any duplicates
         if other_names_list:
-            dedupe_names_list = []
-            dedupe_names_list.append(raw_data['name'].upper())
+            dedupe_names = {name.upper()}
             corrected_name_list = []
             for other_name_data in other_names_list:
                 name_org = other_name_data['NAME_ORG']
                 if len(name_org.split()) > 16:
                     stat_update_list.append(['_FYI', 'longNameCnt', record_id + ' | ' + other_name_data['NAME_ORG']])
                     name_org = ' '.join(name_org.split()[:16])
-                if name_org.upper() in dedupe_names_list:
+                if name_org.upper() in dedupe_names:
                     stat_update_list.append(['_FYI', 'DUPLICATE_NAME_IGNORED', record_id + ' | ' + other_name_data['NAME_ORG']])
                     continue
                 other_name_data['NAME_ORG'] = name_org
-                dedupe_names_list.append(name_org.upper())
+                dedupe_names.add(name_org.upper())
                 corrected_name_list.append(other_name_data)
             if corrected_name_list:
                 json_data['OTHER_NAMES'] = corrected_name_list
+            if tracer:
+                tracer.stage('names')
 
         #--registered address above, plus child file addresses
         if 'address' in self.child_table_list:
-            dedupe_addrs_list = [orjson.dumps(registered_address_for_dedupe, option=orjson.OPT_SORT_KEYS)]
+            # the addresses are compared by their sorted items, the registered one included
+            dedupe_addrs = {tuple(sorted(registered_address_for_dedupe.items()))}
             addr_list = []
-            sql = 'select * from address where company_number = ? and jurisdiction_code = ?'
-            for addr_record in sql_fetch_all(sql_exec(self.dbo, sql, [raw_data['company_number'], raw_data['jurisdiction_code']])):
+            for addr_record in self.child_rows('address', company_number, jurisdiction_code, record_id, stat_update_list):
                 addr_type = 'UNKNOWN' if not addr_record['ADDRESS_TYPE'] else addr_record['ADDRESS_TYPE'].upper()
                 stat_update_list.append(['_FYI', 'ADDRESS_TYPES', addr_type])
 
@@ -737,19 +1004,22 @@ class mapper():
                     stat_update_list.append(['_FYI', 'NON_REG_ADDR_PARSED_COUNT', record_id])
 
                 addr_data = {}
+                address_value = self.address_value
                 if addr_record['IN_FULL']:
-                    addr_data['ADDR_FULL'] = remove_line_feeds(addr_record['IN_FULL']).upper()
-                    addr_data['ADDR_COUNTRY'] = remove_line_feeds(addr_record['COUNTRY']).upper()
+                    addr_data['ADDR_FULL'] = address_value(addr_record['IN_FULL'])
+                    addr_data['ADDR_COUNTRY'] = address_value(addr_record['COUNTRY'])
                 else:
-                    addr_data['ADDR_LINE1'] = remove_line_feeds(addr_record['STREET_ADDRESS']).upper()
-                    addr_data['ADDR_CITY'] = remove_line_feeds(addr_record['LOCALITY']).upper()
-                    addr_data['ADDR_STATE'] = remove_line_feeds(addr_record['REGION']).upper()
-                    addr_data['ADDR_POSTAL_CODE'] = remove_line_feeds(addr_record['POSTAL_CODE']).upper()
-                    addr_data['ADDR_COUNTRY'] = remove_line_feeds(addr_record['COUNTRY']).upper()
-
-                if orjson.dumps(addr_data, option=orjson.OPT_SORT_KEYS).decode() in dedupe_addrs_list:
+                    addr_data['ADDR_LINE1'] = address_value(addr_record['STREET_ADDRESS'])
+                    addr_data['ADDR_CITY'] = address_value(addr_record['LOCALITY'])
+                    addr_data['ADDR_STATE'] = address_value(addr_record['REGION'])
+                    addr_data['ADDR_POSTAL_CODE'] = address_value(addr_record['POSTAL_CODE'])
+                    addr_data['ADDR_COUNTRY'] = address_value(addr_record['COUNTRY'])
+
+                addr_key = tuple(sorted(addr_data.items()))
+                if addr_key in dedupe_addrs:
                     stat_update_list.append(['_FYI', 'DUPLICATE_ADDR_IGNORED', record_id + ' | ' + orjson.dumps(addr_data).decode()])
                     continue
+                dedupe_addrs.add(addr_key)
 
                 addr_data['ADDR_TYPE'] = addr_type.upper()
                 addr_list.append(addr_data)
@@ -758,13 +1028,15 @@ class mapper():
                 json_data['NON_REG_ADDRESSES'] = addr_list
                 if len(addr_list) > 1:
                     stat_update_list.append(['_FYI', 'HAS_MULTIPLE_NON_REG_ADDRS', record_id])
+            if tracer:
+                tracer.stage('address')
 
         additional_list = []
+        dedupe_additional = set()
 
         # identifier child table
         if 'identifier' in self.child_table_list:
-            sql = 'select * from identifier where company_number = ? and jurisdiction_code = ?'
-            for record in sql_fetch_all(sql_exec(self.dbo, sql, [raw_data['company_number'], raw_data['jurisdiction_code']])):
+            for record in self.child_rows('identifier', company_number, jurisdiction_code, record_id, stat_update_list):
                 if not record['UID']:
                     continue
                 identifier_data = {}
@@ -778,54 +1050,106 @@ class mapper():
                     identifier_data['OTHER_ID_TYPE'] = record['IDENTIFIER_SYSTEM_CODE']
                     identifier_data['OTHER_ID_NUMBER'] = record['UID']
                     stat_update_list.append(['_FYI', 'IDENTIFIER_TYPES', record['IDENTIFIER_SYSTEM_CODE'] + '=TAX_ID'])
-                if identifier_data not in additional_list:  #--lot of dupes in here!
+                if tuple(identifier_data.items()) not in dedupe_additional:  #--lot of dupes in here!
+                    dedupe_additional.add(tuple(identifier_data.items()))
                     additional_list.append(identifier_data)
+            if tracer:
+                tracer.stage('identifier')
 
         # telephone child table (eventually convert their type field)
         if 'telephone' in self.child_table_list:
-            sql = 'select * from telephone where company_number = ? and jurisdiction_code = ?'
-            for record in sql_fetch_all(sql_exec(self.dbo, sql, [raw_data['company_number'], raw_data['jurisdiction_code']])):
+            for record in self.child_rows('telephone', company_number, jurisdiction_code, record_id, stat_update_list):
                 if not record['NUMBER']:
                     continue
                 phone_data = {"PHONE_NUMBER": record['NUMBER']}
-                if phone_data not in additional_list:
+                if tuple(phone_data.items()) not in dedupe_additional:
+                    dedupe_additional.add(tuple(phone_data.items()))
                     additional_list.append(phone_data)
+            if tracer:
+                tracer.stage('telephone')
 
         # website child table
         if 'website' in self.child_table_list:
-            sql = 'select * from website where company_number = ? and jurisdiction_code = ?'
-            for record in sql_fetch_all(sql_exec(self.dbo, sql, [raw_data['company_number'], raw_data['jurisdiction_code']])):
+            for record in self.child_rows('website', company_number, jurisdiction_code, record_id, stat_update_list):
                 if not record['URL']:
                     continue
                 website_data = {"WEBSITE_ADDRESS": record['URL']}
-                if website_data not in additional_list:
+                if tuple(website_data.items()) not in dedupe_additional:
+                    dedupe_additional.add(tuple(website_data.items()))
                     additional_list.append(website_data)
+            if tracer:
+                tracer.stage('website')
 
         if additional_list:
             json_data['ADDITIONAL_DATA'] = additional_list
 
 
-        # compute record hash with this data
+        # compute record hash with this data, it is only used by the duplicate analysis
         json_data = remove_empty_json_values(json_data)
-        base_json_string = orjson.dumps(json_data, option=orjson.OPT_SORT_KEYS).decode()
-        record_hash = hashlib.md5(bytes(base_json_string, 'utf-8')).hexdigest()
+        record_hash = self.record_hasher(orjson.dumps(json_data, option=orjson.OPT_SORT_KEYS)) if self.record_hasher else None
 
         #--create the relationship anchor for officers/and headquarters
         relationship_list = [{'REL_ANCHOR_DOMAIN': 'OPENC', 'REL_ANCHOR_KEY': record_id}]
 
         #--create the relationship pointer from branches to their headquarters
-        if raw_data['home_jurisdiction_company_number']:
+        if home_jurisdiction_company_number:
             relationship_data = {}
-            relationship_data['REL_POINTER_KEY'] = raw_data['home_jurisdiction_company_number'] + '-' + raw_data['home_jurisdiction_code']
+            relationship_data['REL_POINTER_KEY'] = home_jurisdiction_company_number + '-' + home_jurisdiction_code
             relationship_data['REL_POINTER_DOMAIN'] = "OPENC"
             relationship_data['REL_POINTER_ROLE'] = "BRANCH_OF"
             relationship_list.append(relationship_data)
 
         payload_data = remove_empty_json_values(payload_data)
 
+        if tracer:
+            tracer.stage('finish')
+            slow_stat = tracer.finish(record_id)
+            if slow_stat:
+                stat_update_list.append(slow_stat)
+
         return record_id, record_hash, json_data, payload_data, relationship_list, stat_update_list
 
 
+def key_hash(company_number, jurisdiction_code):
+    ''' must match the one openc-load-childb.py builds the store with '''
+    return int.from_bytes(hashlib.blake2b(f'{company_number}\t{jurisdiction_code}'.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+def open_child_database(file_name):
+    ''' the loaded child database must not change while mapping, see child_database_stamp '''
+    dbo = sqlite3.connect(f'file:{file_name}?mode=ro&immutable=1', uri=True)
+    dbo.cursor().execute(f'pragma mmap_size = {child_mmap_size}')
+    dbo.cursor().execute(f'pragma cache_size = {child_cache_size}')
+    return dbo
+
+
+def child_database_stamp(file_name):
+    ''' a load or update always writes the child database itself, even when it only rebuilds its shards or store '''
+    return os.stat(file_name).st_mtime_ns
+
+
+def child_database_finished(file_name):
+    child_dbo = sqlite3.connect(f'file:{file_name}?mode=ro', uri=True)
+    finished = child_dbo.cursor().execute("select 1 from sqlite_master where type='table' and name='finished'").fetchone() is not None
+    child_dbo.close()
+    return finished
+
+
+def shard_key(shard_by, shard_count, company_number, jurisdiction_code):
+    ''' must match the one openc-load-childb.py shards the child rows with '''
+    if shard_by == 'jurisdiction':
+        return jurisdiction_code or ''
+    return str(key_hash(company_number, jurisdiction_code) % shard_count)
+
+
+def bloom_positions(company_number, jurisdiction_code, bit_count, hash_count):
+    ''' must match the one openc-load-childb.py builds the filters with '''
+    digest = hashlib.blake2b(f'{company_number}\t{jurisdiction_code}'.encode('utf-8'), digest_size=16).digest()
+    hash1 = int.from_bytes(digest[:8], 'little')
+    hash2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(hash1 + i * hash2) % bit_count for i in range(hash_count)]
+
+
 def clean_value(raw_value):
     if not raw_value:
         return ''
@@ -841,6 +1165,10 @@ def remove_line_feeds(raw_value):
     return raw_value.replace('\\n', ' ')
 
 
+def normalize_address_value(raw_value):
+    return remove_line_feeds(raw_value).upper()
+
+
 def remove_empty_json_values(value):
     """
     Recursively remove all None values from dictionaries and lists, and returns
@@ -898,18 +1226,6 @@ def sql_fetch_all(cursor_data):
     return row_list
 
 
-def safe_csv_next(reader, counter):
-    while True:
-        try:
-            counter += 1
-            return next(reader), counter
-        except StopIteration:
-            return None, counter
-        except Exception as err:
-            counter += 1
-            print(f"error: row {input_row_count} {err}")
-
-
 def format_statistic(amt):
     amt = int(amt)
     if amt > 1000000:
@@ -931,83 +1247,154 @@ if __name__ == "__main__":
     data_source = 'OPENC-COMPANY'
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input_file_name', dest='input_file_name', help='the name of an open corporates csv file for companies')
+    parser.add_argument('-i', '--input_file_name', dest='input_file_name', help='the name of an open corporates csv file for companies, or a directory or glob of its part files')
     parser.add_argument('-o', '--output_file_name', dest='output_file_name', help='the name of the output file')
     parser.add_argument('-c', '--child_database_name', dest='child_database_name', help='the name of the child database created in the prior step')
     parser.add_argument('-d', '--data_source', dest='data_source', default=data_source, help='the name of the data source code to use, defaults to: ' + data_source)
     parser.add_argument('-l', '--log_file', dest='log_file', help='optional name of the statistics log file')
     parser.add_argument('-w', '--max_workers', type=int, help='defaults to the number of system processors, may need to reduce if running other things at same time')
+    parser.add_argument('-m', '--max_child_rows', dest='max_child_rows', type=int, help='the most rows of each child table mapped for a company, defaults to no cap')
     parser.add_argument('-D', '--log_duplicates', dest='log_duplicates', action='store_true', default=False, help='perform duplicate analysis')
+    parser.add_argument('-g', '--feature_groups', dest='feature_groups', help='comma separated list of the optional feature and payload groups to map, defaults to all of: ' + ','.join(company_feature_groups))
+    parser.add_argument('-k', '--cache_size', dest='cache_size', type=int, default=100000, help='the most values each process keeps in its normalization caches, 0 turns them off, defaults to 100000')
+    parser.add_argument('-T', '--slow_threshold', dest='slow_threshold', type=float, help='optional milliseconds above which a company is reported as slow with the time of each stage and its child row counts')
+    parser.add_argument('-s', '--sample', dest='sample', type=float, help='optional fraction of the companies to map, chosen by the hash of their company number and jurisdiction so the same ones are chosen each time')
+    parser.add_argument('-S', '--stratify', dest='stratify', action='store_true', default=False, help='with -s, make sure each jurisdiction gets at least its share of the sample')
+    parser.add_argument('-H', '--hash_algorithm', dest='hash_algorithm', choices=['md5', 'blake2b', 'xxhash'], default='blake2b', help='the record hash for the duplicate analysis, defaults to blake2b')
     args = parser.parse_args()
 
     if not args.output_file_name:
         print('\nPlease supply a valid output file name on the command line\n')
         sys.exit(1)
 
-    if not args.input_file_name or not os.path.exists(args.input_file_name):
-        print('\nPlease supply a valid input file name on the command line\n')
+    file_list = input_file_list(args.input_file_name) if args.input_file_name else []
+    if not file_list:
+        print('\nPlease supply a valid input file name, directory or glob on the command line\n')
         sys.exit(1)
 
     if not args.child_database_name or not os.path.exists(args.child_database_name):
         print('\nPlease supply a child database file name on the command line\n')
         sys.exit(1)
 
+    if args.hash_algorithm == 'xxhash' and not xxhash:
+        print('\nThe xxhash module is not installed, pip install xxhash or choose another hash algorithm\n')
+        sys.exit(1)
+
+    if args.cache_size < 0:
+        print('\nThe cache size cannot be negative\n')
+        sys.exit(1)
+
+    if args.slow_threshold is not None and args.slow_threshold < 0:
+        print('\nThe slow threshold cannot be negative\n')
+        sys.exit(1)
+
+    if args.sample is not None and not 0 < args.sample <= 1:
+        print('\nThe sample must be a fraction greater than 0 and at most 1\n')
+        sys.exit(1)
+
+    if args.stratify and args.sample is None:
+        print('\nA stratified sample needs the fraction to sample with -s\n')
+        sys.exit(1)
+
+    if args.max_child_rows is not None and args.max_child_rows < 1:
+        print('\nThe child row cap must be at least 1\n')
+        sys.exit(1)
+
+    # the columns of the groups left out are never parsed or cleaned and their child tables are never looked up
+    feature_groups = [x.strip().lower() for x in args.feature_groups.split(',') if x.strip()] if args.feature_groups else list(company_feature_groups)
+    unknown_groups = [x for x in feature_groups if x not in company_feature_groups]
+    if unknown_groups:
+        print(f"\nUnknown feature group {', '.join(unknown_groups)}, choose from {', '.join(company_feature_groups)}\n")
+        sys.exit(1)
+    excluded_columns = set()
+    excluded_tables = set()
+    for group_name in company_feature_groups:
+        if group_name not in feature_groups:
+            excluded_columns.update(company_feature_groups[group_name][0])
+            excluded_tables.update(company_feature_groups[group_name][1])
+
     child_dbo = sqlite3.connect(f'file:{args.child_database_name}?mode=ro', uri=True, check_same_thread=False)
-    child_table_list = [x[0] for x in child_dbo.cursor().execute("select name from sqlite_master where type='table'").fetchall()]
+    child_table_list = [x[0] for x in child_dbo.cursor().execute("select name from sqlite_master where type='table'").fetchall() if x[0] not in excluded_tables]
     if 'finished' not in child_table_list:
         print('\nThe child database load is not complete.  The make-openc-child-db.py process must first run to successful completion.')
         sys.exit(1)
     child_dbo.close()
+    # the mappers read it immutable, so it is checked for a change by its modified time when they open it and after the run
+    child_db_stamp = child_database_stamp(args.child_database_name)
+    child_database_changed = multiprocessing.Value('i', 0)
 
     progress_interval = 100000
     proc_start_time = time.time()
     input_row_count = 0
     output_row_count = 0
 
-    file_name = args.input_file_name
-    base_file_name, file_extension = os.path.splitext(file_name)
-    compressed_file = file_extension.upper() == '.GZ'
-    if compressed_file:
-        base_file_name, file_extension = os.path.splitext(base_file_name)
-        input_file_handle = gzip.open(file_name, 'r')
-        csv_reader = csv.DictReader(io.TextIOWrapper(io.BufferedReader(input_file_handle), encoding='utf-8', errors='ignore'))
-    else:
-        input_file_handle = open(file_name, 'r')
-        csv_reader = csv.DictReader(input_file_handle, dialect='excel')
-
+    # the mappers compile a column plan against each file's header, the rows are sent as lists
+    header_list = []
+    for file_name in file_list:
+        input_file_handle, csv_reader, header = open_csv_file(file_name)
+        input_file_handle.close()
+        header_list.append(header)
+        missing_columns = [x for x in company_source_columns + [x[0] for x in company_column_mappings] if x not in header and x not in excluded_columns]
+        if missing_columns:
+            print(f"warning: {', '.join(sorted(set(missing_columns)))} not in {file_name}, mapped as empty\n")
+
+    file_name = file_list[0] if len(file_list) == 1 else f'{len(file_list)} files'
     output_file_name = args.output_file_name
     print (f'\nMapping {file_name} into {output_file_name} ...\n')
+    if args.sample is not None:
+        print(f"sampling {args.sample:.2%} of the companies{' stratified by jurisdiction' if args.stratify else ''}\n")
+    if excluded_columns or excluded_tables:
+        print(f"skipping the {', '.join(x for x in company_feature_groups if x not in feature_groups)} feature groups\n")
 
     kwargs = {'data_source': args.data_source,
               'child_database_name': args.child_database_name,
               'child_table_list': child_table_list,
+              'child_database_stamp': child_db_stamp,
+              'child_database_changed': child_database_changed,
+              'header_list': header_list,
+              'excluded_columns': excluded_columns,
               'output_file_name': output_file_name,
               'log_file': args.log_file,
               'log_duplicates': args.log_duplicates,
+              'max_child_rows': args.max_child_rows,
+              'cache_size': args.cache_size,
+              'slow_threshold': args.slow_threshold,
+              'hash_algorithm': args.hash_algorithm,
               'progress_interval': progress_interval,
               'proc_start_time': proc_start_time}
     if args.max_workers:
         kwargs['process_count'] = args.max_workers
 
+    # the sample is chosen here so the rows left out are never sent to the mappers
+    sampler = row_sampler(header_list, args.sample) if args.sample is not None else None
+    if args.stratify:
+        print(f"counting the jurisdictions of {file_name} for the stratified sample\n")
+        sampler.stratify(file_list)
+    sampled_row_count = 0
+
     queue_processor = IOQueueProcessor(mapper, writer, **kwargs)
     print(f"\nstarting {queue_processor.process_count} processes\n")
     queue_processor.start_up()
 
-    input_row, input_row_count = safe_csv_next(csv_reader, input_row_count)
-    while input_row:
-
-        queue_processor.process(input_row)
-        input_row, input_row_count = safe_csv_next(csv_reader, input_row_count)
-        if shut_down:
-            break
+    # the parts are read at the same time by their own processes into the same mappers and writer
+    for file_number, row_list in parallel_batch_reader(file_list, 1000, lambda: shut_down or child_database_changed.value):
+        input_row_count += len(row_list)
+        for input_row in row_list:
+            if not sampler or sampler.keep(file_number, input_row):
+                queue_processor.process((file_number, input_row))
+                sampled_row_count += 1
 
     queue_processor.finish_up()
-    input_file_handle.close()
 
     elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
     run_status = ('completed in' if not shut_down else 'aborted after') + f' {elapsed_mins:,} minutes'
     print(f"{input_row_count:,} rows processed {run_status}\n")
+    if sampler:
+        print(f"{sampled_row_count:,} rows sampled{f' from {len(sampler.thresholds):,} jurisdictions' if args.stratify else ''}\n")
 
+    if child_database_changed.value or child_database_stamp(args.child_database_name) != child_db_stamp or not child_database_finished(args.child_database_name):
+        print(f"\n{args.child_database_name} was changed during the run, the output is not valid and must be mapped again\n")
+        sys.exit(1)
 
     sys.exit(0)
 
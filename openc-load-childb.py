@@ -4,118 +4,524 @@ import sys
 import os
 import glob
 import sqlite3
-import pandas
 import time
 import argparse
+import csv
+import gzip
+import io
+import signal
+import hashlib
+import array
+import itertools
+import math
+import re
+import orjson
+import multiprocessing
 
-def make_database(dbname, child_file_types):
+# the columns of each child table, the csv headers are matched to these by name
+child_table_columns = {
+    'address': ['company_number', 'jurisdiction_code', 'address_type', 'street_address', 'locality', 'region', 'postal_code', 'country', 'country_code', 'in_full', 'start_date', 'end_date'],
+    'alias': ['company_number', 'jurisdiction_code', 'name', 'type', 'start_date', 'end_date'],
+    'identifier': ['company_number', 'jurisdiction_code', 'uid', 'identifier_system_code'],
+    'telephone': ['company_number', 'jurisdiction_code', 'country_code', 'number', 'raw_number', 'number_type', 'start_date', 'end_date'],
+    'website': ['company_number', 'jurisdiction_code', 'country_code', 'url', 'raw_url', 'number_type', 'start_date', 'end_date']
+}
+
+# the columns with a handful of distinct values that -e stores as integer codes
+encoded_columns = ['jurisdiction_code', 'address_type', 'type', 'identifier_system_code', 'number_type', 'country_code']
+
+# larger pages keep the index trees shallow for the mapper's lookups
+child_page_size = 8192
+
+# the bloom filters are sized for this rate of false positives
+bloom_error_rate = 0.01
+
+# values loaded as null, the same ones pandas.read_csv used to treat as missing
+null_values = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+def clean_value(raw_value):
+    ''' the companies mapper's clean_value rules, with empty values loaded as null '''
+    new_value = ' '.join(raw_value.split())
+    if new_value in null_values or new_value.upper() in ['NULL', 'NUL', 'N/A']:
+        return None
+    return new_value
+
+
+def table_sql(table_name, filetype, clustered=False, encoded=False):
+    column_sql = ', '.join(f'{column_name} INTEGER' if encoded and column_name in encoded_columns else f'{column_name} TEXT' for column_name in child_table_columns[filetype])
+    if not clustered:
+        return f'CREATE TABLE IF NOT EXISTS {table_name} ({column_sql})'
+
+    # clustered on the lookup key so each company's rows are stored together, seq keeps duplicate rows apart
+    return f'CREATE TABLE IF NOT EXISTS {table_name} ({column_sql}, seq INTEGER, PRIMARY KEY (company_number, jurisdiction_code, seq)) WITHOUT ROWID'
+
+
+def make_database(dbname, child_file_types, clustered, encoded, shard=False):
     child_dbo = sqlite3.connect(dbname, isolation_level=None, timeout=20)
+    child_dbo.cursor().execute(f'pragma page_size = {child_page_size}') # only takes effect on a new database
 
-    if 'address' in child_file_types:
-        sql = 'CREATE TABLE IF NOT EXISTS address (' \
-              ' company_number TEXT,' \
-              ' jurisdiction_code TEXT,' \
-              ' address_type TEXT,' \
-              ' street_address TEXT,' \
-              ' locality TEXT,' \
-              ' region TEXT,' \
-              ' postal_code TEXT,' \
-              ' country TEXT,' \
-              ' country_code TEXT,' \
-              ' in_full TEXT,' \
-              ' start_date TEXT,' \
-              ' end_date TEXT' \
-              ' )'
-        child_dbo.cursor().execute(sql)
-
-    if 'alias' in child_file_types:
-        sql = 'CREATE TABLE IF NOT EXISTS alias (' \
-              ' company_number TEXT,' \
-              ' jurisdiction_code TEXT,' \
-              ' name TEXT,' \
-              ' type TEXT,' \
-              ' start_date TEXT,' \
-              ' end_date TEXT' \
-              ' )'
-        child_dbo.cursor().execute(sql)
-
-    if 'identifier' in child_file_types:
-        sql = 'CREATE TABLE IF NOT EXISTS identifier (' \
-              ' company_number TEXT,' \
-              ' jurisdiction_code TEXT,' \
-              ' uid TEXT,' \
-              ' identifier_system_code TEXT' \
-              ' )'
-        child_dbo.cursor().execute(sql)
-
-    if 'telephone' in child_file_types:
-        sql = 'CREATE TABLE IF NOT EXISTS telephone (' \
-              ' company_number TEXT,' \
-              ' jurisdiction_code TEXT,' \
-              ' country_code TEXT,' \
-              ' number TEXT,' \
-              ' raw_number TEXT,' \
-              ' number_type TEXT,' \
-              ' start_date TEXT,' \
-              ' end_date TEXT' \
-              ' )'
-        child_dbo.cursor().execute(sql)
-
-    if 'website' in child_file_types:
-        sql = 'CREATE TABLE IF NOT EXISTS website (' \
-              ' company_number TEXT,' \
-              ' jurisdiction_code TEXT,' \
-              ' country_code TEXT,' \
-              ' url TEXT,' \
-              ' raw_url TEXT,' \
-              ' number_type TEXT,' \
-              ' start_date TEXT,' \
-              ' end_date TEXT' \
-              ' )'
-        child_dbo.cursor().execute(sql)
+    for filetype in child_file_types:
+        child_dbo.cursor().execute(table_sql(filetype, filetype, clustered, encoded))
+    if not shard:
+        child_dbo.cursor().execute('CREATE TABLE IF NOT EXISTS loaded_files (file_name TEXT PRIMARY KEY, file_type TEXT, file_size INTEGER, file_checksum TEXT, record_count INTEGER, loaded_at TEXT)')
+        child_dbo.cursor().execute('CREATE TABLE IF NOT EXISTS bloom_filter (table_name TEXT PRIMARY KEY, bit_count INTEGER, hash_count INTEGER, key_count INTEGER, bits BLOB)')
+        child_dbo.cursor().execute('CREATE TABLE IF NOT EXISTS load_progress (file_name TEXT PRIMARY KEY, file_type TEXT, file_size INTEGER, file_checksum TEXT, '
+                                   'record_count INTEGER, completed INTEGER, update_mode INTEGER)')
+        if encoded:
+            child_dbo.cursor().execute('CREATE TABLE IF NOT EXISTS child_codes (column_name TEXT, code INTEGER, value TEXT, PRIMARY KEY (column_name, code))')
 
     child_dbo.close()
 
 
-def import_file(child_dbo, filedata, record_chunk_size):
+def connect_database(dbname, update):
+    child_dbo = sqlite3.connect(dbname)
+    child_dbo_cursor = child_dbo.cursor()
+    # the journal stays on so a load that stops part way through can be resumed
+    if not update:
+        child_dbo_cursor.execute('pragma synchronous = 0')
+    child_dbo_cursor.execute('pragma temp_store = MEMORY')
+    child_dbo_cursor.execute('pragma locking_mode = EXCLUSIVE')
+    child_dbo_cursor.execute('pragma isolation_level = None')
+    return child_dbo
+
+
+def database_tables(dbname):
+    ''' returns the existing tables and whether they were created clustered '''
+    child_dbo = sqlite3.connect(dbname)
+    table_list = {x[0]: 'WITHOUT ROWID' in x[1].upper() for x in child_dbo.cursor().execute("select name, sql from sqlite_master where type='table'").fetchall()}
+    child_dbo.close()
+    return table_list
+
+
+def file_checksum(file_name):
+    checksum = hashlib.md5()
+    with open(file_name, 'rb') as input_file_handle:
+        for chunk in iter(lambda: input_file_handle.read(1048576), b''):
+            checksum.update(chunk)
+    return os.path.getsize(file_name), checksum.hexdigest()
+
+
+def make_load_database(child_dbo, load_database_name, child_file_types, encoded, resume=False):
+    ''' clustered tables are loaded into plain tables in a separate file first so they can be inserted in key order '''
+    if os.path.exists(load_database_name) and not resume:
+        os.remove(load_database_name)
+    child_dbo.cursor().execute('attach database ? as load', (load_database_name,))
+    for filetype in child_file_types:
+        child_dbo.cursor().execute(table_sql(f'load.{filetype}', filetype, encoded=encoded))
+
+
+def shard_key(shard_by, shard_count, company_number, jurisdiction_code):
+    ''' the companies mapper must route its lookups the same way '''
+    if shard_by == 'jurisdiction':
+        return jurisdiction_code or ''
+    return str(key_hash(company_number, jurisdiction_code) % shard_count)
+
+
+def shard_file_name(dbname, shard_key):
+    return f"{dbname}-shard-{re.sub('[^A-Za-z0-9_]', '_', shard_key) or 'none'}"
+
+
+class shard_router():
+    ''' the writer's connections to the shard databases, opened when the first rows for a shard arrive '''
+
+    def __init__(self, child_dbo, dbname, shard_by, shard_count, table_types, child_file_types, clustered, encoded, update, resume):
+        self.child_dbo = child_dbo
+        self.dbname = dbname
+        self.shard_by = shard_by
+        self.shard_count = shard_count
+        self.table_types = table_types
+        self.child_file_types = child_file_types
+        self.clustered = clustered
+        self.encoded = encoded
+        self.update = update
+        self.resume = resume
+        self.shard_dbos = {}
+        self.new_tables = {}
+
+    def connection(self, shard_key):
+        if shard_key not in self.shard_dbos:
+            file_name = shard_file_name(self.dbname, shard_key)
+            self.new_tables[shard_key] = set(self.table_types) - set(database_tables(file_name) if os.path.exists(file_name) else {})
+            make_database(file_name, self.table_types, self.clustered, self.encoded, shard=True)
+            self.child_dbo.execute('insert or ignore into shards values (?, ?, ?, ?)', (self.shard_by, self.shard_count, shard_key, os.path.basename(file_name)))
+            self.child_dbo.commit()
+            self.shard_dbos[shard_key] = connect_database(file_name, self.update)
+            if self.clustered or self.update:
+                make_load_database(self.shard_dbos[shard_key], file_name + '-load', self.child_file_types, self.encoded, self.resume)
+        return self.shard_dbos[shard_key]
+
+    def close(self):
+        for shard_dbo in self.shard_dbos.values():
+            shard_dbo.commit()
+            shard_dbo.close()
+
+
+class column_encoder():
+    ''' replaces the encoded column values with integer codes, assigning new codes as new values are seen '''
+
+    def __init__(self, code_list):
+        self.codes = {}
+        for column_name, code, value in code_list:
+            self.codes.setdefault(column_name, {})[value] = code
+        self.new_codes = []
+        self.positions = {filetype: [(position, column_name) for position, column_name in enumerate(child_table_columns[filetype]) if column_name in encoded_columns] for filetype in child_table_columns}
+
+    def encode_rows(self, filetype, row_list):
+        for position, column_name in self.positions[filetype]:
+            codes = self.codes.setdefault(column_name, {})
+            for row in row_list:
+                value = row[position]
+                if value is None:
+                    continue
+                if value not in codes:
+                    codes[value] = len(codes) + 1
+                    self.new_codes.append((column_name, codes[value], value))
+                row[position] = codes[value]
+
+    def save(self, child_dbo):
+        child_dbo.executemany('insert into child_codes values (?, ?, ?)', self.new_codes)
+        self.new_codes = []
+
+
+def init_parser(queue, shard_by, shard_count):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global parse_queue, parse_shard_by, parse_shard_count
+    parse_queue = queue
+    parse_shard_by = shard_by
+    parse_shard_count = shard_count
+
+
+def queue_rows(file_number, row_list, bytes_read):
+    ''' sharded rows are sent to the writer in a batch per shard, the last one carries the chunk's progress '''
+    chunk_progress = (len(row_list), bytes_read)
+    if not parse_shard_by:
+        parse_queue.put((file_number, None, row_list, chunk_progress))
+        return
+    shard_rows = {}
+    for row in row_list:
+        shard_rows.setdefault(shard_key(parse_shard_by, parse_shard_count, row[0], row[1]), []).append(row)
+    shard_keys = list(shard_rows)
+    for key in shard_keys:
+        parse_queue.put((file_number, key, shard_rows[key], chunk_progress if key == shard_keys[-1] else None))
+
+
+def parse_file(file_number, filedata, record_chunk_size, skip_count):
+    ''' worker process: parses a child file into batches of table rows for the writer '''
     filetype = filedata[0]
     filename = filedata[1]
-    print(f"{filename}: started")
+    print(f"{filename}: started" if not skip_count else f"{filename}: resuming after {skip_count:,} records")
+    completed = False
 
-    if os.path.splitext(filename)[1].upper() == '.GZ':
-        file_compression = 'gzip'
-    else:
-        file_compression = None
+    try:
+        # the raw file's position is the progress through a compressed file
+        raw_file_handle = open(filename, 'rb')
+        if os.path.splitext(filename)[1].upper() == '.GZ':
+            input_file_handle = io.TextIOWrapper(io.BufferedReader(gzip.GzipFile(fileobj=raw_file_handle)), encoding='utf-8', newline='')
+        else:
+            input_file_handle = io.TextIOWrapper(raw_file_handle, encoding='utf-8', newline='')
+        csv_reader = csv.reader(input_file_handle)
+
+        # missing columns are loaded as null and extra ones are ignored
+        header = next(csv_reader, [])
+        column_positions = [header.index(column_name) if column_name in header else None for column_name in child_table_columns[filetype]]
 
-    cnt = 0
-    for chunk in pandas.read_csv(filename, chunksize=record_chunk_size, encoding='utf-8', dtype = str, compression=file_compression):
-        timer_start = time.time()
-        chunk.to_sql(filetype, child_dbo, index=False, method='multi', chunksize=1000, if_exists='append')
-        cnt += len(chunk)
-        print(f"{filename}: {cnt:,} records loaded, batch rate {round(time.time() - timer_start, 1)} seconds")
+        # a gzip file cannot seek, so the rows already loaded are read and skipped
+        for _ in itertools.islice(csv_reader, skip_count):
+            pass
+
+        row_list = []
+        for csv_row in csv_reader:
+            table_row = []
+            for position in column_positions:
+                table_row.append(clean_value(csv_row[position]) if position is not None and position < len(csv_row) else None)
+            row_list.append(table_row)
+            if len(row_list) == record_chunk_size:
+                queue_rows(file_number, row_list, raw_file_handle.tell())
+                row_list = []
+        if row_list:
+            queue_rows(file_number, row_list, raw_file_handle.tell())
+        input_file_handle.close()
+        completed = True
+
+    finally: # the writer waits for every file to finish, even one that failed
+        parse_queue.put((file_number, None, None, completed))
 
     return f"{filename} completed!"
 
 
+def import_files(child_dbo, child_files, file_progress, record_chunk_size, process_count, staged, router=None, encoder=None):
+    ''' the files are parsed in parallel, this process is the only writer and records each file's progress after every chunk '''
+    table_prefix = 'load.' if staged else ''
+    insert_sql = {filetype: f'INSERT INTO {table_prefix}{filetype} VALUES (' + ', '.join(['?'] * len(child_table_columns[filetype])) + ')' for filetype in child_table_columns}
+    file_counts = [x[0] for x in file_progress]
+    file_start_times = [None] * len(child_files)
+    batch_start_times = [None] * len(child_files)
+    load_file_numbers = [file_number for file_number in range(len(child_files)) if not file_progress[file_number][1]]
+
+    queue = multiprocessing.Queue(process_count * 4)
+    shard_settings = (router.shard_by, router.shard_count) if router else (None, None)
+    with multiprocessing.Pool(process_count, initializer=init_parser, initargs=(queue, *shard_settings)) as pool:
+        results = [pool.apply_async(parse_file, (file_number, child_files[file_number], record_chunk_size, file_counts[file_number])) for file_number in load_file_numbers]
+
+        files_remaining = len(load_file_numbers)
+        while files_remaining:
+            file_number, shard_key, row_list, chunk_progress = queue.get()
+            filetype, filename = child_files[file_number]
+            if not file_start_times[file_number]:
+                file_start_times[file_number] = batch_start_times[file_number] = time.time()
+            if row_list is None:
+                files_remaining -= 1
+                if chunk_progress: # only a file that was read to the end is complete
+                    child_dbo.execute('update load_progress set completed = 1 where file_name = ?', (os.path.basename(filename),))
+                    child_dbo.commit()
+                elapsed_seconds = max(time.time() - file_start_times[file_number], 0.001)
+                record_count = file_counts[file_number] - file_progress[file_number][0]
+                byte_count = os.path.getsize(filename) # a resumed file is still read from the start
+                print(f"{filename}: {record_count:,} records loaded in {round(elapsed_seconds, 1):,} seconds, "
+                      f"{round(record_count / elapsed_seconds):,} records and {round(byte_count / elapsed_seconds / 1048576, 1):,} MB per second")
+                continue
+
+            # new codes are saved before the rows that use them, and the rows before the progress that covers them
+            if encoder:
+                encoder.encode_rows(filetype, row_list)
+                if encoder.new_codes:
+                    encoder.save(child_dbo)
+                    child_dbo.commit()
+            insert_dbo = router.connection(shard_key) if router else child_dbo
+            insert_dbo.executemany(insert_sql[filetype], row_list)
+            insert_dbo.commit()
+            if chunk_progress:
+                file_counts[file_number] += chunk_progress[0]
+                child_dbo.execute('update load_progress set record_count = ? where file_name = ?', (file_counts[file_number], os.path.basename(filename)))
+                child_dbo.commit()
+                percent_read = round(chunk_progress[1] / max(os.path.getsize(filename), 1) * 100)
+                print(f"{filename}: {file_counts[file_number]:,} records loaded, {percent_read}% of the file, batch rate {round(time.time() - batch_start_times[file_number], 1)} seconds")
+                batch_start_times[file_number] = time.time()
+
+        # raises any error a parser had
+        for result in results:
+            result.get()
+
+    return file_counts
+
+
 def index_database(child_dbo, filetype):
     print(f"indexing {filetype} ...")
     timer_start = time.time()
-    child_dbo.cursor().execute(f'create index ix_{filetype} on {filetype} (company_number, jurisdiction_code)')
+    child_dbo.cursor().execute(f'create index if not exists ix_{filetype} on {filetype} (company_number, jurisdiction_code)')
     print(f"indexing {filetype} completed in {round(time.time() - timer_start, 1)} seconds")
     return f"{filetype} indexing complete"
 
 
+def cluster_table(child_dbo, filetype):
+    ''' replaces the index, the sorted insert keeps the clustered table's pages full and in order '''
+    print(f"clustering {filetype} ...")
+    timer_start = time.time()
+    column_list = child_table_columns[filetype]
+    select_list = ['ifnull(company_number, \'\')', 'ifnull(jurisdiction_code, \'\')'] + column_list[2:] + ['rowid']
+    child_dbo.cursor().execute(f'insert into {filetype} ({", ".join(column_list)}, seq) '
+                               f'select {", ".join(select_list)} from load.{filetype} order by 1, 2, rowid')
+    child_dbo.cursor().execute(f'drop table load.{filetype}')
+    child_dbo.commit()
+    print(f"clustering {filetype} completed in {round(time.time() - timer_start, 1)} seconds")
+    return f"{filetype} clustering complete"
+
+
+def replace_company_rows(child_dbo, filetype, clustered):
+    ''' update mode: the companies in the new files replace all of their existing rows '''
+    print(f"replacing {filetype} ...")
+    timer_start = time.time()
+    column_list = child_table_columns[filetype]
+    if clustered:
+        key_list = 'ifnull(company_number, \'\'), ifnull(jurisdiction_code, \'\')'
+        select_list = [key_list] + column_list[2:] + ['rowid']
+        column_list = column_list + ['seq']
+    else:
+        key_list = 'company_number, jurisdiction_code'
+        select_list = column_list
+    delete_count = child_dbo.execute(f'delete from main.{filetype} where (company_number, jurisdiction_code) in '
+                                     f'(select distinct {key_list} from load.{filetype})').rowcount
+    insert_count = child_dbo.execute(f'insert into main.{filetype} ({", ".join(column_list)}) '
+                                     f'select {", ".join(select_list)} from load.{filetype} order by 1, 2, rowid').rowcount
+    child_dbo.execute(f'drop table load.{filetype}')
+    print(f"replacing {filetype} completed in {round(time.time() - timer_start, 1)} seconds, {delete_count:,} rows removed, {insert_count:,} rows added")
+    return f"{filetype} replacing complete"
+
+
+def record_loaded_files(child_dbo, child_files, file_info, file_counts):
+    loaded_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    for file_number in range(len(child_files)):
+        filetype, filename = child_files[file_number]
+        child_dbo.execute('insert or replace into loaded_files values (?, ?, ?, ?, ?, ?)',
+                          (os.path.basename(filename), filetype, file_info[file_number][0], file_info[file_number][1], file_counts[file_number], loaded_at))
+
+
+def key_hash(company_number, jurisdiction_code):
+    ''' 63 bits so sqlite sorts the keys the same way as an unsigned array '''
+    return int.from_bytes(hashlib.blake2b(f'{company_number}\t{jurisdiction_code}'.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+
+def store_file_names(dbname, filetype):
+    return f'{dbname}.{filetype}.idx', f'{dbname}.{filetype}.dat'
+
+
+def build_mmap_store(child_dbo, dbname, filetype, clustered):
+    ''' writes a table's rows grouped by company in key hash order, the index file holds the sorted hashes then the data offsets
+
+        each group is a line with the company's key and row count followed by a line per row, so a capped lookup only parses the rows it keeps '''
+    print(f"building {filetype} store ...")
+    timer_start = time.time()
+    index_file_name, data_file_name = store_file_names(dbname, filetype)
+    column_list = child_table_columns[filetype]
+    hash_array = array.array('Q')
+    offset_array = array.array('Q', [0])
+    record_count = 0
+
+    # rows without a key can never be looked up
+    cursor = child_dbo.execute(f'select key_hash(company_number, jurisdiction_code), {", ".join(column_list)} from {filetype} '
+                               f'where company_number is not null and jurisdiction_code is not null '
+                               f'order by 1, 2, 3, {"seq" if clustered else "rowid"}')
+    with open(data_file_name + '.tmp', 'wb') as data_file_handle:
+        for key, row_group in itertools.groupby(cursor, key=lambda row: row[0:3]):
+            row_list = [orjson.dumps(row[3:]) for row in row_group]
+            data_bytes = b'\n'.join([orjson.dumps([key[1], key[2], len(row_list)])] + row_list) + b'\n'
+            data_file_handle.write(data_bytes)
+            hash_array.append(key[0])
+            offset_array.append(offset_array[-1] + len(data_bytes))
+            record_count += len(row_list)
+    with open(index_file_name + '.tmp', 'wb') as index_file_handle:
+        hash_array.tofile(index_file_handle)
+        offset_array.tofile(index_file_handle)
+
+    # replaced rather than rewritten so a mapper still reading the old files is not affected
+    os.replace(data_file_name + '.tmp', data_file_name)
+    os.replace(index_file_name + '.tmp', index_file_name)
+    child_dbo.execute('insert or replace into mmap_store values (?, ?, ?, ?)', (filetype, ','.join(column_list), len(hash_array), record_count))
+    print(f"building {filetype} store completed in {round(time.time() - timer_start, 1)} seconds, {len(hash_array):,} companies")
+    return f"{filetype} store complete"
+
+
+def bloom_positions(company_number, jurisdiction_code, bit_count, hash_count):
+    ''' double hashing, the companies mapper must compute the same positions '''
+    digest = hashlib.blake2b(f'{company_number}\t{jurisdiction_code}'.encode('utf-8'), digest_size=16).digest()
+    hash1 = int.from_bytes(digest[:8], 'little')
+    hash2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(hash1 + i * hash2) % bit_count for i in range(hash_count)]
+
+
+def build_bloom_filter(child_dbo, filetype, source_dbo_list):
+    ''' lets the companies mapper skip the lookup for the companies that have no rows in a table, the source list has a connection per shard '''
+    print(f"building {filetype} bloom filter ...")
+    timer_start = time.time()
+    key_sql = f'select distinct company_number, jurisdiction_code from {filetype} where company_number is not null and jurisdiction_code is not null'
+    key_count = sum(source_dbo.execute(f'select count(*) from ({key_sql})').fetchone()[0] for source_dbo in source_dbo_list)
+    bit_count = max(64, math.ceil(-key_count * math.log(bloom_error_rate) / math.log(2) ** 2))
+    hash_count = max(1, round(bit_count / max(key_count, 1) * math.log(2)))
+    bits = bytearray((bit_count + 7) // 8)
+    for source_dbo in source_dbo_list:
+        for company_number, jurisdiction_code in source_dbo.execute(key_sql):
+            for position in bloom_positions(company_number, jurisdiction_code, bit_count, hash_count):
+                bits[position >> 3] |= 1 << (position & 7)
+    child_dbo.execute('insert or replace into bloom_filter values (?, ?, ?, ?, ?)', (filetype, bit_count, hash_count, key_count, bytes(bits)))
+    print(f"building {filetype} bloom filter completed in {round(time.time() - timer_start, 1)} seconds, {key_count:,} companies in {len(bits):,} bytes")
+    return f"{filetype} bloom filter complete"
+
+
+def analyze_database(child_dbo):
+    ''' gives the query planner statistics, the limit keeps it from reading every index page '''
+    print("analyzing ...")
+    timer_start = time.time()
+    child_dbo.cursor().execute('pragma analysis_limit = 1000')
+    child_dbo.cursor().execute('analyze')
+    print(f"analyzing completed in {round(time.time() - timer_start, 1)} seconds")
+
+
+def vacuum_database(child_dbo):
+    ''' rewrites the database without free pages, mainly of use after updates '''
+    print("vacuuming ...")
+    timer_start = time.time()
+    child_dbo.cursor().execute(f'pragma page_size = {child_page_size}')
+    child_dbo.cursor().execute('vacuum')
+    print(f"vacuuming completed in {round(time.time() - timer_start, 1)} seconds")
+
+
+def remove_duplicates(child_dbo, table_name, filetype):
+    ''' exact duplicate rows add nothing for the mapper, the first one loaded is kept '''
+    print(f"removing duplicate {filetype} rows ...")
+    timer_start = time.time()
+    column_list = ', '.join(child_table_columns[filetype])
+    delete_count = child_dbo.execute(f'delete from {table_name} where rowid in (select rowid from (select rowid, row_number() over '
+                                     f'(partition by {column_list} order by rowid) as row_number from {table_name}) where row_number > 1)').rowcount
+    child_dbo.commit()
+    print(f"removing duplicate {filetype} rows completed in {round(time.time() - timer_start, 1)} seconds, {delete_count:,} rows removed")
+
+
+def finish_tables(child_dbo, child_file_types, new_tables, clustered, update):
+    staged = clustered or update
+    load_tables = [x[0] for x in child_dbo.cursor().execute("select name from load.sqlite_master where type='table'").fetchall()] if staged else []
+    for filetype in sorted(set(child_file_types) | new_tables):
+        print()
+        # a resumed load skips the tables it finished before it stopped
+        if staged and filetype in child_file_types and filetype not in load_tables:
+            print(f"{filetype} already finished")
+            continue
+        if filetype in child_file_types:
+            remove_duplicates(child_dbo, f'load.{filetype}' if clustered or update else filetype, filetype)
+        if update:
+            if filetype in child_file_types:
+                replace_company_rows(child_dbo, filetype, clustered)
+            # only a new table lacks its index, checking them all also covers a new table after a resume
+            if not clustered:
+                index_database(child_dbo, filetype)
+        elif clustered:
+            cluster_table(child_dbo, filetype)
+        else:
+            index_database(child_dbo, filetype)
+
+
+def finish_shard(task):
+    ''' worker process: the same steps as an unsharded database, for one shard '''
+    file_name, child_file_types, new_tables, clustered, update, vacuum = task
+    timer_start = time.time()
+    shard_dbo = connect_database(file_name, update)
+    staged = clustered or update
+    if staged:
+        shard_dbo.cursor().execute('attach database ? as load', (file_name + '-load',))
+    finish_tables(shard_dbo, child_file_types, new_tables, clustered, update)
+    print()
+    analyze_database(shard_dbo)
+    shard_dbo.commit()
+    if staged:
+        shard_dbo.cursor().execute('detach database load')
+        if os.path.exists(file_name + '-load'):
+            os.remove(file_name + '-load')
+    if vacuum:
+        print()
+        vacuum_database(shard_dbo)
+    shard_dbo.close()
+    return f"{os.path.basename(file_name)} completed in {round(time.time() - timer_start, 1)} seconds"
+
+
 def complete_database(child_dbo):
     child_dbo.cursor().execute('create table finished (dummy integer)')
 
 
 if __name__ == "__main__":
 
-    record_chunk_size = 1000000
+    record_chunk_size = 100000
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input_file_dir', dest='input_file_dir', help='the name of the open corporates csv file directory')
     parser.add_argument('-c', '--child_database_name', dest='child_database_name', help='the name of the database file to create')
+    parser.add_argument('-w', '--max_workers', type=int, help='defaults to the number of system processors, may need to reduce if running other things at same time')
+    parser.add_argument('-C', '--clustered', dest='clustered', action='store_true', default=False, help='store the child rows clustered by company instead of indexing them')
+    parser.add_argument('-m', '--mmap_store', dest='mmap_store', action='store_true', default=False, help='also write the child rows to memory mapped lookup files for the companies mapper')
+    parser.add_argument('-V', '--vacuum', dest='vacuum', action='store_true', default=False, help='vacuum the database when done')
+    parser.add_argument('-e', '--encode', dest='encode', action='store_true', default=False, help='store the low cardinality columns as integer codes')
+    parser.add_argument('-s', '--shard_by', dest='shard_by', choices=['jurisdiction', 'hash'], help='split the child rows into a database per jurisdiction or per hash bucket')
+    parser.add_argument('-S', '--shard_count', dest='shard_count', type=int, default=16, help='the number of hash buckets, defaults to 16')
+    parser.add_argument('-u', '--update', dest='update', action='store_true', default=False, help='apply new or changed files to an existing database instead of rebuilding it')
+    parser.add_argument('-r', '--resume', dest='resume', action='store_true', default=False, help='resume a load or update that did not complete')
     args = parser.parse_args()
 
     if not args.input_file_dir or not os.path.isdir(args.input_file_dir):
@@ -126,6 +532,10 @@ if __name__ == "__main__":
         print('\nPlease supply a sqlite database file name on the command line\n')
         sys.exit(1)
 
+    if args.shard_count < 1:
+        print('\nThe shard count must be at least 1\n')
+        sys.exit(1)
+
     # note: telephones and websites are experimental and may not be present
 
     child_file_types = []
@@ -151,29 +561,168 @@ if __name__ == "__main__":
         print('Child file names must contain: "*non_reg_addresses*", "*alternative_names*" or "*additional_identifiers*".\n')
         sys.exit(1)
 
-    if os.path.exists(args.child_database_name):
+    # a resumed load carries on in the mode it was started in
+    resume_progress = {}
+    if args.resume:
+        table_list = database_tables(args.child_database_name) if os.path.exists(args.child_database_name) else {}
+        if 'finished' in table_list:
+            print(f"\n{args.child_database_name} is already complete\n")
+            sys.exit(0)
+        if 'load_progress' not in table_list:
+            print(f"\n{args.child_database_name} has no load to resume\n")
+            sys.exit(1)
+        child_dbo = sqlite3.connect(args.child_database_name)
+        resume_progress = {x[0]: x[1:] for x in child_dbo.cursor().execute('select file_name, file_size, file_checksum, record_count, completed, update_mode from load_progress').fetchall()}
+        child_dbo.close()
+        args.update = any(x[4] for x in resume_progress.values())
+
+    if args.update:
+        if not os.path.exists(args.child_database_name):
+            print(f"\n{args.child_database_name} does not exist, it must be fully loaded before it can be updated\n")
+            sys.exit(1)
+    elif os.path.exists(args.child_database_name) and not args.resume:
         os.remove(args.child_database_name)
         #print(f"\n{dbname} already exists, please remove it first if you want to continue\n")
         #sys.exit(1)
+        for file_name in glob.glob(glob.escape(args.child_database_name) + '.*.idx') + glob.glob(glob.escape(args.child_database_name) + '.*.dat') + \
+                         glob.glob(glob.escape(args.child_database_name) + '-shard-*'):
+            os.remove(file_name)
+
+    process_count = min(args.max_workers if args.max_workers else multiprocessing.cpu_count(), len(child_files))
 
     proc_start = time.time()
-    print(f"\n{len(child_files)} files to load\n")
-    make_database(args.child_database_name, child_file_types)
+    with multiprocessing.Pool(process_count) as pool:
+        file_info = pool.map(file_checksum, [x[1] for x in child_files])
 
-    child_dbo = sqlite3.connect(args.child_database_name)
+    # update mode skips any file already loaded with the same size and checksum and keeps the existing table layout
+    new_tables = set(child_file_types)
+    table_list = {}
+    shard_list = []
+    if args.update or args.resume:
+        table_list = database_tables(args.child_database_name)
+        args.clustered = any(table_list.get(filetype) for filetype in child_table_columns)
+        args.encode = 'child_codes' in table_list
+        new_tables -= set(table_list)
+        loaded_files = set()
+        child_dbo = sqlite3.connect(args.child_database_name)
+        if 'loaded_files' in table_list:
+            loaded_files = set(child_dbo.cursor().execute('select file_name, file_size, file_checksum from loaded_files').fetchall())
+        if 'shards' in table_list:
+            shard_list = child_dbo.cursor().execute('select shard_by, shard_count, shard_key from shards').fetchall()
+        child_dbo.close()
+        args.shard_by, args.shard_count = (shard_list[0][0], shard_list[0][1]) if shard_list else (None, args.shard_count)
+        for file_number in reversed(range(len(child_files))):
+            if (os.path.basename(child_files[file_number][1]), *file_info[file_number]) in loaded_files:
+                print(f"{child_files[file_number][1]}: already loaded")
+                del child_files[file_number], child_file_types[file_number], file_info[file_number]
+        if not child_files:
+            print('\nNo new or changed files to load\n')
+            sys.exit(0)
+
+    if args.shard_by and (args.mmap_store or 'mmap_store' in table_list):
+        print('\nThe memory mapped store cannot be built for a sharded database\n')
+        sys.exit(1)
+
+    print(f"\n{len(child_files)} files to load with {process_count} processes\n")
+    make_database(args.child_database_name, child_file_types, args.clustered, args.encode)
+    table_types = [filetype for filetype in child_table_columns if filetype in database_tables(args.child_database_name)]
+
+    child_dbo = connect_database(args.child_database_name, args.update)
     child_dbo_cursor = child_dbo.cursor()
-    child_dbo_cursor.execute('pragma synchronous = 0')
-    child_dbo_cursor.execute('pragma journal_mode = off')
-    child_dbo_cursor.execute('pragma temp_store = MEMORY')
-    child_dbo_cursor.execute('pragma locking_mode = EXCLUSIVE')
-    child_dbo_cursor.execute('pragma isolation_level = None')
-    for filedata in child_files:
-        print()
-        import_file(child_dbo, filedata, record_chunk_size)
-    for filetype in child_file_types:
+    if args.update:
+        # the mappers will not start until the update is committed along with the new finished marker
+        child_dbo_cursor.execute('drop table if exists finished')
+        child_dbo.commit()
+
+    # progress is kept for the files not yet loaded, the others start from the beginning
+    file_progress = []
+    new_progress = []
+    for file_number in range(len(child_files)):
+        filetype, filename = child_files[file_number]
+        progress = resume_progress.get(os.path.basename(filename))
+        if progress and progress[2] and tuple(progress[0:2]) != tuple(file_info[file_number]):
+            print(f"\n{filename} has changed since the load stopped, it must be loaded again without -r\n")
+            sys.exit(1)
+        if progress and progress[2]:
+            file_progress.append(progress[2:4])
+        else:
+            file_progress.append((0, 0))
+            new_progress.append((os.path.basename(filename), filetype, *file_info[file_number], 0, 0, int(args.update)))
+    if not args.resume:
+        child_dbo_cursor.execute('delete from load_progress')
+    child_dbo.executemany('insert or replace into load_progress (file_name, file_type, file_size, file_checksum, record_count, completed, update_mode) '
+                          'values (?, ?, ?, ?, ?, ?, ?)', new_progress)
+    child_dbo.commit()
+
+    encoder = None
+    if args.encode:
+        encoder = column_encoder(child_dbo_cursor.execute('select column_name, code, value from child_codes').fetchall())
+
+    # a sharded database keeps its rows in the shards, the tables here are left empty
+    router = None
+    staged = args.clustered or args.update
+    if args.shard_by:
+        child_dbo_cursor.execute('CREATE TABLE IF NOT EXISTS shards (shard_by TEXT, shard_count INTEGER, shard_key TEXT PRIMARY KEY, file_name TEXT)')
+        router = shard_router(child_dbo, args.child_database_name, args.shard_by, args.shard_count, table_types, child_file_types, args.clustered, args.encode, args.update, args.resume)
+        # every hash bucket gets a database, all the shards need any new table and a resumed load finishes every shard
+        shard_keys = [str(x) for x in range(args.shard_count)] if args.shard_by == 'hash' else []
+        if new_tables or args.resume:
+            shard_keys += [x[2] for x in shard_list]
+        for key in shard_keys:
+            router.connection(key)
+    elif staged:
+        load_database_name = args.child_database_name + '-load'
+        make_load_database(child_dbo, load_database_name, child_file_types, args.encode, args.resume)
+    file_counts = import_files(child_dbo, child_files, file_progress, record_chunk_size, process_count, staged, router, encoder)
+
+    if args.shard_by:
+        router.close()
+        print(f"\nfinishing {len(router.shard_dbos)} shards with {process_count} processes")
+        shard_tasks = [(shard_file_name(args.child_database_name, key), child_file_types, router.new_tables[key], args.clustered, args.update, args.vacuum) for key in router.shard_dbos]
+        with multiprocessing.Pool(process_count) as pool:
+            for result in pool.imap_unordered(finish_shard, shard_tasks):
+                print(result)
+    else:
+        finish_tables(child_dbo, child_file_types, new_tables, args.clustered, args.update)
+
+    # an existing store is always kept in step with its tables
+    if args.mmap_store or 'mmap_store' in table_list:
+        store_tables = set(child_file_types)
+        if 'mmap_store' not in table_list:
+            store_tables |= {filetype for filetype in child_table_columns if filetype in table_list}
+        child_dbo.create_function('key_hash', 2, key_hash, deterministic=True)
+        child_dbo_cursor.execute('CREATE TABLE IF NOT EXISTS mmap_store (table_name TEXT PRIMARY KEY, column_list TEXT, key_count INTEGER, record_count INTEGER)')
+        for filetype in sorted(store_tables):
+            print()
+            build_mmap_store(child_dbo, args.child_database_name, filetype, args.clustered)
+
+    # a database loaded before there were filters gets them for every table
+    filter_tables = set(child_file_types)
+    if args.update and 'bloom_filter' not in table_list:
+        filter_tables |= {filetype for filetype in child_table_columns if filetype in table_list}
+    source_dbo_list = [child_dbo]
+    if args.shard_by:
+        source_dbo_list = [sqlite3.connect(shard_file_name(args.child_database_name, x[0])) for x in child_dbo_cursor.execute('select shard_key from shards').fetchall()]
+    for filetype in sorted(filter_tables):
         print()
-        index_database(child_dbo, filetype)
+        build_bloom_filter(child_dbo, filetype, source_dbo_list)
+    if args.shard_by:
+        for source_dbo in source_dbo_list:
+            source_dbo.close()
+
+    print()
+    analyze_database(child_dbo)
+
+    record_loaded_files(child_dbo, child_files, file_info, file_counts)
+    child_dbo_cursor.execute('delete from load_progress')
     complete_database(child_dbo)
+    child_dbo.commit()
+    if staged and not args.shard_by:
+        child_dbo_cursor.execute('detach database load')
+        os.remove(load_database_name)
+    if args.vacuum:
+        print()
+        vacuum_database(child_dbo)
 
     child_dbo.close()
 
@@ -3,7 +3,6 @@
 import sys
 import os
 import argparse
-import csv
 import orjson
 import time
 from datetime import datetime
@@ -11,12 +10,18 @@ from dateutil.parser import parse as dateparse
 import signal
 import random
 import gzip
-import io
 import sqlite3
-import hashlib
+import multiprocessing
+import itertools
+import functools
+from queue import Empty, Full
+
+from openc_common import bounded_imap, cache_hit_rates, cache_stat_updates, column_plan, input_file_list, open_csv_file, parallel_batch_reader, record_hasher, record_tracer, xxhash
 
 max_records_per_entity = 10000
 max_relationships_per_role = 1000
+fetch_size = 10000
+shut_down = False
 
 def make_database(dbname, use_existing_db):
     temp_dbo = sqlite3.connect(dbname)
@@ -34,48 +39,132 @@ def make_database(dbname, use_existing_db):
 
     if not use_existing_db:
         #temp_dbo_cursor.execute('create table hashes(hash CHAR(40), record_count int, base_json VARCHAR(255), ids TEXT, rels TEXT)')
-        temp_dbo_cursor.execute('create table hashes(hash CHAR(40), base_json VARCHAR(255))')
+        temp_dbo_cursor.execute('create table hashes(hash BLOB, base_json VARCHAR(255))')
+        temp_dbo_cursor.execute('create table duplicates(hash BLOB, record_id VARCHAR(50), role VARCHAR(50), rel_json TEXT)')
         temp_dbo.commit()
 
     return temp_dbo
 
 
 #=========================
+# the columns mapper.map reads itself, unpacked in this order
+officer_source_columns = ['type', 'id', 'name', 'first_name', 'last_name', 'title', 'company_number', 'jurisdiction_code', 'position', 'start_date', 'end_date',
+                          'address.street_address', 'address.locality', 'address.region', 'address.postal_code', 'address.country', 'address.in_full']
+
+# the columns mapped straight to an attribute, in output order: (column, attribute, transform, json or payload)
+officer_column_mappings = [
+    # columnName: occupation
+    # 1.16 populated, 28.73 unique
+    #      DIRECTOR (115)
+    #      COMPANY DIRECTOR (41)
+    #      CONSULTANT (20)
+    #      ACCOUNTANT (14)
+    #      SECRETARY (11)
+    ('occupation', 'occupation', None, 'payload'),
+    # columnName: person_number
+    # 1.76 populated, 87.19 unique
+    #      064559030001 (6)
+    #      900001120001 (4)
+    #      900001110001 (4)
+    #      124967240002 (3)
+    #      143139560001 (3)
+    ('person_number', 'OC_OFFICER_NUMBER', None, 'json'),
+    # columnName: person_uid
+    # 7.51 populated, 74.07 unique
+    #      10130615 (14)
+    #      831909905 (13)
+    #      4000448343 (11)
+    #      121486802 (10)
+    #      284541 (9)
+    ('person_uid', 'OC_OFFICER_UID', None, 'json'),
+    # columnName: nationality
+    # 3.42 populated, 4.39 unique
+    #      BG (483)
+    #      BRITISH (447)
+    #      ENGLISH (17)
+    #      RU (17)
+    #      IT (16)
+    ('nationality', 'NATIONALITY', None, 'json'),
+    # columnName: country_of_residence
+    # 0.93 populated, 7.07 unique
+    #      UNITED KINGDOM (157)
+    #      ENGLAND (99)
+    #      NORTHERN IRELAND (7)
+    #      GERMANY (5)
+    #      WALES (4)
+    ('country_of_residence', 'COUNTRY_OF_ASSOCIATION', None, 'json'),
+    # columnName: partial_date_of_birth
+    # 1.3 populated, 67.07 unique
+    #      1972-03 (6)
+    #      1961-09 (5)
+    #      1965-05 (5)
+    #      1970-05 (4)
+    #      1966-07 (4)
+    ('partial_date_of_birth', 'DATE_OF_BIRTH', 'date_of_birth', 'json'),
+    # columnName: source_url
+    # 1.76 populated, 35.41 unique
+    #      https://beta.companieshouse.gov.uk/company/05149111 (46)
+    #      https://beta.companieshouse.gov.uk/company/SC227540 (10)
+    #      https://beta.companieshouse.gov.uk/company/01278121 (10)
+    #      https://beta.companieshouse.gov.uk/company/NI044930 (8)
+    #      https://beta.companieshouse.gov.uk/company/05671230 (8)
+    ('source_url', 'source_url', None, 'payload')]
+
+# the heavily repeated columns, cleaned through the mapper's cache
+officer_cached_columns = ['type', 'name', 'first_name', 'last_name', 'title', 'jurisdiction_code', 'position', 'start_date', 'end_date',
+                          'address.street_address', 'address.locality', 'address.region', 'address.postal_code', 'address.country', 'address.in_full',
+                          'occupation', 'nationality', 'country_of_residence', 'partial_date_of_birth']
+
+
 class mapper():
 
-    def __init__(self):
+    def __init__(self, data_source, header_list=None, cache_size=0):
 
+        self.data_source = data_source
         self.load_reference_data()
         self.stat_pack = {}
-
-
-    def map(self, raw_data):
+        # the repeated values are cleaned and normalized through bounded lru caches, a size of 0 turns them off
+        self.caches = {}
+        self.cache_counts = {}
+        if cache_size:
+            self.caches['CLEAN'] = functools.lru_cache(maxsize=cache_size)(self.clean_value)
+            self.caches['ADDRESS'] = functools.lru_cache(maxsize=cache_size)(self.normalize_address_value)
+            self.caches['DATE_OF_BIRTH'] = functools.lru_cache(maxsize=cache_size)(self.format_dob)
+        self.address_value = self.caches.get('ADDRESS', self.normalize_address_value)
+        # a plan per input file as the parts may not share a header
+        self.column_plans = [column_plan(header, officer_source_columns, officer_column_mappings, {'date_of_birth': self.caches.get('DATE_OF_BIRTH', self.format_dob)}, self.clean_value,
+                                         cached_columns=officer_cached_columns, cached_clean_function=self.caches.get('CLEAN')) for header in header_list or []]
+
+
+    def map(self, raw_row, file_number=0):
         json_data = {}
         payload_data = {}
 
-        # clean values
-        for attribute in raw_data:
-            raw_data[attribute] = self.clean_value(raw_data[attribute])
+        # clean values, the columns read here come first
+        plan = self.column_plans[file_number]
+        values = plan.read(raw_row)
+        officer_type, officer_id, name, first_name, last_name, title, company_number, jurisdiction_code, position, start_date, end_date, \
+            street_address, locality, region, postal_code, country, in_full = values[0:plan.source_count]
 
         # place any filters needed here
 
         # place any calculations needed here
 
         # mandatory attributes
-        json_data['DATA_SOURCE'] = args.data_source
+        json_data['DATA_SOURCE'] = self.data_source
 
         # record type replaces entity type helps keeps persons from resolving to companies
         # columnName: type
         # 13.09 populated, 0.05 unique
         #      Person (3764)
         #      Company (419)
-        if raw_data['type'].upper() == 'COMPANY':
+        if officer_type.upper() == 'COMPANY':
             json_data['RECORD_TYPE'] = 'ORGANIZATION'
         else:
             json_data['RECORD_TYPE'] = 'PERSON'
 
         # the record_id should be unique, remove this mapping if there is not one
-        record_id = raw_data['id']
+        record_id = officer_id
         json_data['RECORD_ID'] = record_id
 
         # column mappings
@@ -87,7 +176,7 @@ class mapper():
         #      201499298 (1)
         #      201499319 (1)
         #      201499336 (1)
-        #json_data['id'] = raw_data['id']
+        #json_data['id'] = officer_id
 
         # columnName: company_number
         # 100.0 populated, 38.52 unique
@@ -96,7 +185,7 @@ class mapper():
         #      05149111 (46)
         #      551 (46)
         #      142962 (46)
-        #json_data['company_number'] = raw_data['company_number']
+        #json_data['company_number'] = company_number
 
         # columnName: jurisdiction_code
         # 100.0 populated, 0.24 unique
@@ -105,7 +194,7 @@ class mapper():
         #      ca_ns (1070)
         #      us_fl (1030)
         #      us_ma (938)
-        #json_data['jurisdiction_code'] = raw_data['jurisdiction_code']
+        #json_data['jurisdiction_code'] = jurisdiction_code
 
         # columnName: position
         # 97.73 populated, 1.62 unique
@@ -114,7 +203,7 @@ class mapper():
         #      president (1328)
         #      incorporator (1293)
         #      secretary (1265)
-        #payload_data['position'] = raw_data['position']
+        #payload_data['position'] = position
 
         # columnName: name
         # 99.96 populated, 71.24 unique
@@ -124,16 +213,16 @@ class mapper():
         #      Registered Agents Inc (96)
         #      LEGALINC CORPORATE SERVICES INC (82)
         if json_data['RECORD_TYPE'] == 'ORGANIZATION':
-            json_data['PRIMARY_NAME_ORG'] = raw_data['name']
+            json_data['PRIMARY_NAME_ORG'] = name
             self.update_stat('_FYI', 'NAME_ORG_CNT', record_id)
         else:
 
             # use full name if parsed name not populated
-            if raw_data['name'] and not raw_data['last_name']:
-                json_data['PRIMARY_NAME_FULL'] = raw_data['name']
+            if name and not last_name:
+                json_data['PRIMARY_NAME_FULL'] = name
                 self.update_stat('_FYI', 'NAME_FULL_CNT', record_id)
 
-            elif raw_data['first_name'] or raw_data['last_name']:
+            elif first_name or last_name:
                 self.update_stat('_FYI', 'NAME_PARSED_CNT', record_id)
 
                 # columnName: title
@@ -143,7 +232,7 @@ class mapper():
                 #      MISS (14)
                 #      MS (9)
                 #      MR. (7)
-                json_data['PRIMARY_NAME_PREFIX'] = raw_data['title']
+                json_data['PRIMARY_NAME_PREFIX'] = title
 
                 # columnName: first_name
                 # 5.35 populated, 71.93 unique
@@ -152,7 +241,7 @@ class mapper():
                 #      MICHAEL (13)
                 #      John (11)
                 #      DAVID (9)
-                json_data['PRIMARY_NAME_FIRST'] = raw_data['first_name']
+                json_data['PRIMARY_NAME_FIRST'] = first_name
 
                 # columnName: last_name
                 # 5.68 populated, 65.91 unique
@@ -161,20 +250,11 @@ class mapper():
                 #      SMITH (10)
                 #      DOBSON (10)
                 #      SCOTT (8)
-                json_data['PRIMARY_NAME_LAST'] = raw_data['last_name']
+                json_data['PRIMARY_NAME_LAST'] = last_name
 
             else:
                 self.update_stat('_FYI', 'NAME_MISSING_CNT', record_id)
 
-        # columnName: occupation
-        # 1.16 populated, 28.73 unique
-        #      DIRECTOR (115)
-        #      COMPANY DIRECTOR (41)
-        #      CONSULTANT (20)
-        #      ACCOUNTANT (14)
-        #      SECRETARY (11)
-        payload_data['occupation'] = raw_data['occupation']
-
         # columnName: start_date
         # 14.06 populated, 32.55 unique
         #      2021-02-25 (220)
@@ -182,25 +262,7 @@ class mapper():
         #      2019-03-05 (103)
         #      2016-03-21 (90)
         #      2012-08-06 (83)
-        #payload_data['start_date'] = raw_data['start_date']
-
-        # columnName: person_number
-        # 1.76 populated, 87.19 unique
-        #      064559030001 (6)
-        #      900001120001 (4)
-        #      900001110001 (4)
-        #      124967240002 (3)
-        #      143139560001 (3)
-        json_data['OC_OFFICER_NUMBER'] = raw_data['person_number']
-
-        # columnName: person_uid
-        # 7.51 populated, 74.07 unique
-        #      10130615 (14)
-        #      831909905 (13)
-        #      4000448343 (11)
-        #      121486802 (10)
-        #      284541 (9)
-        json_data['OC_OFFICER_UID'] = raw_data['person_uid']
+        #payload_data['start_date'] = start_date
 
         # columnName: end_date
         # 4.57 populated, 57.6 unique
@@ -209,38 +271,14 @@ class mapper():
         #      1994-09-29 (12)
         #      1995-12-01 (10)
         #      2004-04-22 (10)
-        #payload_data['end_date'] = raw_data['end_date']
-
-        # columnName: nationality
-        # 3.42 populated, 4.39 unique
-        #      BG (483)
-        #      BRITISH (447)
-        #      ENGLISH (17)
-        #      RU (17)
-        #      IT (16)
-        json_data['NATIONALITY'] = raw_data['nationality']
-
-        # columnName: country_of_residence
-        # 0.93 populated, 7.07 unique
-        #      UNITED KINGDOM (157)
-        #      ENGLAND (99)
-        #      NORTHERN IRELAND (7)
-        #      GERMANY (5)
-        #      WALES (4)
-        json_data['COUNTRY_OF_ASSOCIATION'] = raw_data['country_of_residence']
-
-        # columnName: partial_date_of_birth
-        # 1.3 populated, 67.07 unique
-        #      1972-03 (6)
-        #      1961-09 (5)
-        #      1965-05 (5)
-        #      1970-05 (4)
-        #      1966-07 (4)
-        json_data['DATE_OF_BIRTH'] = self.format_dob(raw_data['partial_date_of_birth'])
+        #payload_data['end_date'] = end_date
+
+        # the straight column mappings
+        plan.apply(values, json_data, payload_data)
 
         # log if parsed address is different than full address if both populated
-        if raw_data['address.street_address'] and raw_data['address.in_full']:
-            if raw_data['address.street_address'].upper() not in raw_data['address.in_full'].upper():
+        if street_address and in_full:
+            if street_address.upper() not in in_full.upper():
                 self.update_stat('_FYI', 'ADDR1_NOT_IN_ADDR_FULL', json_data['RECORD_ID'])
 
         # columnName: address.in_full
@@ -250,14 +288,14 @@ class mapper():
         #      400 CORNERSTONE DR #240, WILLISTON, VT, 05495, USA (47)
         #      27821 36TH AVE NW, STANWOOD, WA, 98292-9461, UNITED STATES (42)
         #      C/O THE BLACKSTONE GROUP, 345 PARK AVE. NEW YORK, NY 10154 USA (42)
-        if raw_data['address.in_full']:
+        if in_full:
             self.update_stat('_FYI', 'ADDR_FULL_COUNT', record_id)
-            json_data['PRIMARY_ADDR_FULL'] = self.remove_line_feeds(raw_data['address.in_full']).upper()
-            json_data['PRIMARY_ADDR_COUNTRY'] = raw_data['address.country']
+            json_data['PRIMARY_ADDR_FULL'] = self.address_value(in_full)
+            json_data['PRIMARY_ADDR_COUNTRY'] = country
 
 
-        elif raw_data['address.street_address'] or raw_data['address.locality'] or raw_data['address.region'] or \
-             raw_data['address.postal_code'] or raw_data['address.country']:
+        elif street_address or locality or region or \
+             postal_code or country:
             self.update_stat('_FYI', 'ADDR_PARSED_COUNT', json_data['RECORD_ID'])
 
             # columnName: address.street_address
@@ -267,7 +305,7 @@ class mapper():
             #      PO BOX 27740 (18)
             #      450 VETERANS MEMORIAL PARKWAY, SUITE 7A (17)
             #      222 JEFFERSON BOULEVARD, SUITE 200 (15)
-            json_data['PRIMARY_ADDR_LINE1'] = raw_data['address.street_address']
+            json_data['PRIMARY_ADDR_LINE1'] = street_address
 
             # columnName: address.locality
             # 14.36 populated, 28.65 unique
@@ -276,7 +314,7 @@ class mapper():
             #      PORTLAND (83)
             #      NEW YORK (64)
             #      BOSTON, (49)
-            json_data['PRIMARY_ADDR_CITY'] = raw_data['address.locality']
+            json_data['PRIMARY_ADDR_CITY'] = locality
 
             # columnName: address.region
             # 11.74 populated, 3.04 unique
@@ -285,7 +323,7 @@ class mapper():
             #      OR (314)
             #      NEW YORK (251)
             #      MI (210)
-            json_data['PRIMARY_ADDR_STATE'] = raw_data['address.region']
+            json_data['PRIMARY_ADDR_STATE'] = region
 
             # columnName: address.postal_code
             # 14.81 populated, 45.52 unique
@@ -294,7 +332,7 @@ class mapper():
             #      02888 (23)
             #      12207 (23)
             #      99801 (21)
-            json_data['PRIMARY_ADDR_POSTAL_CODE'] = raw_data['address.postal_code']
+            json_data['PRIMARY_ADDR_POSTAL_CODE'] = postal_code
 
             # columnName: address.country
             # 6.45 populated, 1.41 unique
@@ -303,7 +341,7 @@ class mapper():
             #      United States (252)
             #      NZ (165)
             #      UNITED KINGDOM (133)
-            json_data['PRIMARY_ADDR_COUNTRY'] = raw_data['address.country']
+            json_data['PRIMARY_ADDR_COUNTRY'] = country
 
         # columnName: retrieved_at
         # 100.0 populated, 24.93 unique
@@ -312,17 +350,7 @@ class mapper():
         #      2021-02-21 00:00:00 UTC (538)
         #      2021-03-03 09:10:18 UTC (462)
         #      2020-12-13 00:00:00 UTC (430)
-        #if raw_data['retrieved_at']:  # stoped mapping as affected de-dupe without adding value
-        #    payload_data['retrieved_at'] = raw_data['retrieved_at'][0:10]
-
-        # columnName: source_url
-        # 1.76 populated, 35.41 unique
-        #      https://beta.companieshouse.gov.uk/company/05149111 (46)
-        #      https://beta.companieshouse.gov.uk/company/SC227540 (10)
-        #      https://beta.companieshouse.gov.uk/company/01278121 (10)
-        #      https://beta.companieshouse.gov.uk/company/NI044930 (8)
-        #      https://beta.companieshouse.gov.uk/company/05671230 (8)
-        payload_data['source_url'] = raw_data['source_url']
+        # stoped mapping as affected de-dupe without adding value
 
         # add the payload data (original kept separate to analyze de-dupe with and without)
         json_data.update(payload_data)
@@ -332,14 +360,14 @@ class mapper():
 
         # point the officer to the company they work for
         rel_data = {'REL_POINTER_DOMAIN': 'OPENC',
-                    'REL_POINTER_KEY': raw_data['company_number'] + '-' + raw_data['jurisdiction_code'],
-                    'REL_POINTER_ROLE': raw_data['position'][0:50]} # some job titles (position) can be extra long
+                    'REL_POINTER_KEY': company_number + '-' + jurisdiction_code,
+                    'REL_POINTER_ROLE': position[0:50]} # some job titles (position) can be extra long
         json_data['RELATIONSHIPS'] = [rel_data]
 
-        if raw_data['start_date']:
-            rel_data['REL_POINTER_FROM_DATE'] = raw_data['start_date']
-        if raw_data['end_date']:
-            rel_data['REL_POINTER_THRU_DATE'] = raw_data['end_date']
+        if start_date:
+            rel_data['REL_POINTER_FROM_DATE'] = start_date
+        if end_date:
+            rel_data['REL_POINTER_THRU_DATE'] = end_date
         self.capture_mapped_stats(rel_data)
 
         return json_data
@@ -367,6 +395,10 @@ class mapper():
         return raw_value.replace('\\n', ' ')
 
 
+    def normalize_address_value(self, raw_value):
+        return self.remove_line_feeds(raw_value).upper()
+
+
     def format_dob(self, raw_date):
         try: new_date = dateparse(raw_date)
         except: return ''
@@ -425,6 +457,35 @@ class mapper():
         return
 
 
+    def update_cache_stats(self):
+        ''' adds the cache hits and misses since the last call, the main process sums them across the workers '''
+        for cat1, cat2, example, count in cache_stat_updates(self.caches, self.cache_counts):
+            if cat1 not in self.stat_pack:
+                self.stat_pack[cat1] = {}
+            self.stat_pack[cat1][cat2] = {'count': count}
+
+
+    def merge_stats(self, stat_pack):
+        ''' adds the statistics gathered by a worker process to this one '''
+        for cat1 in stat_pack:
+            for cat2 in stat_pack[cat1]:
+                if cat1 not in self.stat_pack:
+                    self.stat_pack[cat1] = {}
+                if cat2 not in self.stat_pack[cat1]:
+                    self.stat_pack[cat1][cat2] = {}
+                    self.stat_pack[cat1][cat2]['count'] = 0
+                self.stat_pack[cat1][cat2]['count'] += stat_pack[cat1][cat2]['count']
+                for example in stat_pack[cat1][cat2].get('examples', []):
+                    if 'examples' not in self.stat_pack[cat1][cat2]:
+                        self.stat_pack[cat1][cat2]['examples'] = []
+                    if example not in self.stat_pack[cat1][cat2]['examples']:
+                        if len(self.stat_pack[cat1][cat2]['examples']) < 5:
+                            self.stat_pack[cat1][cat2]['examples'].append(example)
+                        else:
+                            randomSampleI = random.randint(2, 4)
+                            self.stat_pack[cat1][cat2]['examples'][randomSampleI] = example
+
+
     def capture_mapped_stats(self, json_data):
 
         if 'DATA_SOURCE' in json_data:
@@ -440,16 +501,349 @@ class mapper():
                     for key2 in subrecord:
                         self.update_stat(data_source, key2, subrecord[key2])
 
-def safe_csv_next(reader, counter):
+
+def init_worker(data_source, header_list=None, hash_algorithm='md5', cache_size=0, slow_threshold=None, sample=None):
+    ''' each worker process gets its own mapper, the main process handles the interrupt '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global worker_mapper, worker_hasher, worker_tracer, worker_sample_threshold
+    worker_mapper = mapper(data_source, header_list, cache_size)
+    worker_hasher = record_hasher(hash_algorithm)
+    worker_tracer = record_tracer(f'process {os.getpid()}', slow_threshold) if slow_threshold is not None else None
+    # a sample is taken by the de-dupe hash, so every duplicate of an officer is kept or left out together
+    worker_sample_threshold = int(sample * (1 << 64)) if sample is not None else None
+
+
+def map_rows(task):
+    ''' step 1 worker: maps a batch of officer rows from one input file and computes their de-dupe hashes '''
+    file_number, row_list = task
+    worker_mapper.stat_pack = {}
+    mapped_list = []
+    tracer = worker_tracer
+    batch_stat_pack = worker_mapper.stat_pack
+    for raw_row in row_list:
+        if tracer:
+            tracer.start()
+        if worker_sample_threshold is not None: # the row's stats are only kept if it is sampled
+            worker_mapper.stat_pack = {}
+        json_data = worker_mapper.map(raw_row, file_number)
+        if tracer:
+            tracer.stage('map')
+        if json_data:
+
+            # extract attributes for compression
+            record_id = json_data['RECORD_ID']
+            rel_data = json_data['RELATIONSHIPS'][0]
+            base_json_data = dict(json_data)
+            del base_json_data['RECORD_ID']
+            del base_json_data['RELATIONSHIPS']
+            record_hash = worker_hasher(orjson.dumps(base_json_data, option=orjson.OPT_SORT_KEYS))
+            if worker_sample_threshold is not None:
+                worker_mapper.stat_pack, row_stat_pack = batch_stat_pack, worker_mapper.stat_pack
+                if int.from_bytes(record_hash[:8], 'big') >= worker_sample_threshold:
+                    continue
+                worker_mapper.merge_stats(row_stat_pack)
+            mapped_list.append((record_hash, record_id, rel_data['REL_POINTER_ROLE'], orjson.dumps(rel_data).decode(), orjson.dumps(json_data).decode()))
+            if tracer:
+                tracer.stage('hash')
+                slow_stat = tracer.finish(record_id)
+                if slow_stat:
+                    worker_mapper.update_stat(*slow_stat)
+
+    worker_mapper.stat_pack = batch_stat_pack
+    worker_mapper.update_cache_stats()
+    return len(row_list), mapped_list, worker_mapper.stat_pack
+
+
+def build_entity(record_hash, base_json, duplicate_iterator, stat_update_list):
+    ''' rebuilds the de-duped officer from the first record mapped and its duplicates '''
+    new_json_data = orjson.loads(base_json)
+
+    # the duplicates are streamed and only counted once past the caps so egregious offenders don't build huge lists
+    record_count = 1
+    record_list = [new_json_data['RECORD_ID']]
+    relation_data = new_json_data['RELATIONSHIPS'][0]
+    role_counts = {relation_data['REL_POINTER_ROLE']: 1}
+    relations_by_role = {relation_data['REL_POINTER_ROLE']: [relation_data]}
+    for duplicate_record in duplicate_iterator:
+        record_id, role, rel_json = duplicate_record[1:]
+        record_count += 1
+        if record_count <= max_records_per_entity:
+            record_list.append(record_id)
+        if role not in role_counts:
+            role_counts[role] = 1
+            relations_by_role[role] = [orjson.loads(rel_json)]
+        else:
+            role_counts[role] += 1
+            if role_counts[role] <= max_relationships_per_role:
+                relations_by_role[role].append(orjson.loads(rel_json))
+            elif relations_by_role[role]:
+                relations_by_role[role] = [] # suppressed, only the count is needed from here on
+
+    new_json_data['RECORD_ID'] = record_hash.hex()
+    new_json_data['RECORD_COUNT'] = record_count
+    if new_json_data['RECORD_COUNT'] > 10000:
+        stat_update_list.append(['_FYI', "RECORD_HASH>10000", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}"])
+    elif new_json_data['RECORD_COUNT'] > 1000:
+        stat_update_list.append(['_FYI', "RECORD_HASH>1000", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}"])
+    elif new_json_data['RECORD_COUNT'] > 100:
+        stat_update_list.append(['_FYI', "RECORD_HASH>100", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}"])
+    if new_json_data['RECORD_COUNT'] < 4:
+        new_json_data['RECORD_IDS'] = ' | '.join(record_list)
+    else:
+        new_json_data['RECORD_IDS'] = ' | '.join(sorted(record_list[0:3])) + f" | + {record_count-3} more"
+    new_json_data['RECORD_LIST'] = [{'id': x} for x in record_list] # capped above so egregious offenders don't slow down the system
+
+    relation_list = []
+    for role in role_counts:
+        if role_counts[role] > max_relationships_per_role:
+            stat_update_list.append(['_FYI', f"ROLE-{role}-SUPPRESSED", f"{new_json_data['RECORD_ID']}={role_counts[role]}"])
+            new_json_data[f"Suppressed {role} relationships"] = role_counts[role]
+        else:
+            relation_list.extend(relations_by_role[role])
+    if relation_list:
+        new_json_data['RELATIONSHIPS'] = relation_list
+
+    return new_json_data
+
+
+def fetch_batches(cursor, fetch_size):
+    ''' iterates the rows of a cursor while fetching them in large batches '''
+    return itertools.chain.from_iterable(iter(lambda: cursor.fetchmany(fetch_size), []))
+
+
+def build_hash_range(task):
+    ''' step 2 worker: rebuilds every officer whose hash starts with the given prefix, returns them ready to be written '''
+    temp_database_name, hash_prefix, compress_output, slow_threshold = task
+    stat_update_list = []
+    output_records = []
+    tracer = record_tracer(f'process {os.getpid()}', slow_threshold) if slow_threshold is not None else None
+
+    # the binary hashes whose first 12 bits are the prefix, the last range has no upper bound
+    hash_range = ((hash_prefix << 4).to_bytes(2, 'big'), ((hash_prefix + 1) << 4).to_bytes(2, 'big') if hash_prefix < 4095 else b'\xff' * 65)
+
+    temp_dbo = sqlite3.connect(f'file:{temp_database_name}?mode=ro', uri=True)
+    hash_cursor = temp_dbo.cursor()
+    hash_cursor.execute('select hash, base_json from hashes where hash >= ? and hash < ? order by hash', hash_range)
+
+    # both cursors are in hash order so each group of duplicates can be streamed into its officer as we go
+    duplicate_cursor = temp_dbo.cursor()
+    duplicate_cursor.execute('select hash, record_id, role, rel_json from duplicates where hash >= ? and hash < ? order by hash, rowid', hash_range)
+    duplicate_groups = itertools.groupby(fetch_batches(duplicate_cursor, fetch_size), key=lambda duplicate_record: duplicate_record[0])
+    duplicate_hash, duplicate_iterator = next(duplicate_groups, (None, None))
+
+    for record_hash, base_json in fetch_batches(hash_cursor, fetch_size):
+        if tracer:
+            tracer.start()
+        while duplicate_hash is not None and duplicate_hash < record_hash:
+            duplicate_hash, duplicate_iterator = next(duplicate_groups, (None, None))
+        if duplicate_hash == record_hash:
+            new_json_data = build_entity(record_hash, base_json, duplicate_iterator, stat_update_list)
+        else:
+            new_json_data = build_entity(record_hash, base_json, [], stat_update_list)
+        if tracer:
+            tracer.stage('rebuild')
+        output_records.append(orjson.dumps(new_json_data) + b'\n')
+        if tracer:
+            tracer.stage('serialize')
+            tracer.rows('duplicates', new_json_data['RECORD_COUNT'] - 1)
+            tracer.rows('relationships', len(new_json_data.get('RELATIONSHIPS', [])))
+            slow_stat = tracer.finish(new_json_data['RECORD_ID'])
+            if slow_stat:
+                stat_update_list.append(slow_stat)
+    temp_dbo.close()
+
+    # shuffled here as the writer only appends the ranges (in random order)
+    random.shuffle(output_records)
+    output_bytes = b''.join(output_records)
+    if compress_output: # a gzip file can be a series of compressed members
+        output_bytes = gzip.compress(output_bytes)
+
+    return output_bytes, len(output_records), stat_update_list
+
+
+def save_mapped_list(temp_dbo, hashes_mapped, mapped_list):
+    ''' the first record for a hash is the base json, all the others are its duplicates '''
+    insert_list = []
+    duplicate_list = []
+    for record_hash, record_id, role, rel_json, json_string in mapped_list:
+        if record_hash not in hashes_mapped:
+            hashes_mapped[record_hash] = 1
+            insert_list.append((record_hash, json_string))
+        else:
+            duplicate_list.append((record_hash, record_id, role, rel_json))
+    temp_dbo.executemany('INSERT INTO hashes VALUES (?, ?)', insert_list)
+    temp_dbo.executemany('INSERT INTO duplicates VALUES (?, ?, ?, ?)', duplicate_list)
+
+
+def finish_database(temp_dbo, completed):
+    ''' step 2 reads the hashes and their duplicates by range '''
+    temp_dbo_cursor = temp_dbo.cursor()
+    temp_dbo_cursor.execute('create index ix_hashes on hashes (hash)')
+    temp_dbo_cursor.execute('create index ix_duplicates on duplicates (hash)')
+
+    # so step 2 can be re-run on its own with -U
+    if completed:
+        temp_dbo_cursor.execute('create table finished (dummy integer)')
+    temp_dbo.commit()
+
+
+def check_database(dbname):
+    if not os.path.exists(dbname):
+        print(f'\nThe temporary database {dbname} does not exist, step 1 must be run first\n')
+        return False
+    temp_dbo = sqlite3.connect(f'file:{dbname}?mode=ro', uri=True)
+    temp_table_list = [x[0] for x in temp_dbo.cursor().execute("select name from sqlite_master where type='table'").fetchall()]
+    hash_type = temp_dbo.cursor().execute('select typeof(hash) from hashes limit 1').fetchone() if 'hashes' in temp_table_list else None
+    temp_dbo.close()
+    if 'finished' not in temp_table_list:
+        print(f'\nThe temporary database {dbname} is not complete.  Step 1 must first run to successful completion.\n')
+        return False
+    if hash_type and hash_type[0] != 'blob':
+        print(f'\nThe temporary database {dbname} has hex hashes from an older version.  Step 1 must be run again.\n')
+        return False
+    return True
+
+
+def hash_range_tasks(temp_database_name, output_file_name, partitions=None, partition_number=None, slow_threshold=None):
+    ''' splits the hashes into 4096 ranges by their first 12 bits, shuffled for randomness in the output '''
+    compress_output = output_file_name.endswith('.gz')
+    task_list = []
+    for i in range(4096):
+        if partitions and (i >> 4) % partitions != partition_number: # partitions own the first byte
+            continue
+        task_list.append((temp_database_name, i, compress_output, slow_threshold))
+    random.shuffle(task_list)
+    return task_list
+
+
+def write_hash_ranges(output_file_name, result_iterator, stat_mapper, stopped):
+    ''' writes the officers rebuilt for each hash range until stopped returns True, returns the number written '''
+    output_file_handle = open(output_file_name, 'wb')
+
+    output_row_count = 0
+    batch_start_time = time.time()
+    for output_bytes, record_count, stat_update_list in result_iterator:
+        for stat_data in stat_update_list:
+            stat_mapper.update_stat(stat_data[0], stat_data[1], stat_data[2])
+
+        output_file_handle.write(output_bytes)
+        prior_row_count = output_row_count
+        output_row_count += record_count
+
+        if output_row_count // 1000000 > prior_row_count // 1000000:
+            elapsed_seconds = round(time.time() - batch_start_time, 1)
+            print(f"{output_row_count:,} rows written to {output_file_name} in {elapsed_seconds:,} seconds")
+            batch_start_time = time.time()
+
+        if stopped():
+            break
+
+    output_file_handle.close()
+
+    return output_row_count
+
+
+def partition_file_name(file_name, partition_number):
+    ''' officers.json.gz becomes officers-1.json.gz '''
+    base_file_name, file_extension = os.path.splitext(file_name)
+    if file_extension.upper() == '.GZ':
+        base_file_name, first_extension = os.path.splitext(base_file_name)
+        file_extension = first_extension + file_extension
+    return f'{base_file_name}-{partition_number}{file_extension}'
+
+
+def aggregate_partition(partition_number, partition_queue, result_queue, **kwargs):
+    ''' runs a partition, an error is sent in place of its result so the main process ends the run rather than waits '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        result_queue.put(run_partition(partition_number, partition_queue, **kwargs))
+    except Exception as err:
+        result_queue.put((partition_number, 0, 0, {}, f'{type(err).__name__}: {err}'))
+
+
+def run_partition(partition_number, partition_queue, **kwargs):
+    ''' de-dupes and writes the officers for the hash prefixes routed to this partition, returns its result '''
+    temp_database_name = partition_file_name(kwargs['temp_database_name'], partition_number)
+    output_file_name = partition_file_name(kwargs['output_file_name'], partition_number)
+    partition_mapper = mapper(kwargs['data_source'])
+    hashes_mapped = {}
+
+    # step 1 - aggregate the mapped officers sent by the main process until it sends None
+    if kwargs['use_existing_db']:
+        if not check_database(temp_database_name):
+            return partition_number, 0, 0, {}, f'{temp_database_name} cannot be used'
+    else:
+        if os.path.exists(temp_database_name):
+            os.remove(temp_database_name)
+        temp_dbo = make_database(temp_database_name, False)
+        completed = True
+        mapped_list = partition_queue.get()
+        while mapped_list:
+            save_mapped_list(temp_dbo, hashes_mapped, mapped_list)
+            mapped_list = partition_queue.get()
+        if mapped_list is not None: # empty list sent on abort
+            completed = False
+        finish_database(temp_dbo, completed)
+        temp_dbo.close()
+
+    # step 2 - rebuild this partition's hash prefixes
+    result_iterator = map(build_hash_range, hash_range_tasks(temp_database_name, output_file_name, kwargs['partitions'], partition_number, kwargs['slow_threshold']))
+    output_row_count = write_hash_ranges(output_file_name, result_iterator, partition_mapper, lambda: kwargs['stop_writing'].value)
+    print(f"partition {partition_number} wrote {output_row_count:,} rows to {output_file_name}")
+
+    return partition_number, len(hashes_mapped), output_row_count, partition_mapper.stat_pack, None
+
+
+def put_partition_queue(partition_queue, partition_process, mapped_list):
+    ''' waits for room in a partition's queue, returns False if the partition has stopped '''
     while True:
         try:
-            counter += 1
-            return counter, next(reader)
-        except StopIteration:
-            return counter, None
-        except Exception as err:
-            counter += 1
-            print(f"error: row {input_row_count} {err}")
+            partition_queue.put(mapped_list, True, 1)
+            return True
+        except Full:
+            if not partition_process.is_alive():
+                return False
+
+
+def partition_results(result_queue, partition_process_list, stop_writing=None):
+    ''' the result of each partition, or None once one fails or stops without sending one
+
+        the partitions ignore the interrupt, so on one they are told to stop writing and still send what they wrote '''
+    result_list = []
+    waiting = set(range(len(partition_process_list)))
+    while waiting:
+        try:
+            result = result_queue.get(True, 1)
+        except Empty:
+            if shut_down and stop_writing and not stop_writing.value:
+                stop_writing.value = 1
+            # a partition that has exited has already sent whatever it was going to
+            stopped = [x for x in waiting if partition_process_list[x].exitcode is not None]
+            if not stopped:
+                continue
+            try:
+                result = result_queue.get(True, 1)
+            except Empty:
+                for partition_number in stopped:
+                    print(f"partition {partition_number} stopped with exit code {partition_process_list[partition_number].exitcode} and no result")
+                return None
+        if result[4]:
+            print(f"partition {result[0]} failed: {result[4]}")
+            return None
+        waiting.discard(result[0])
+        result_list.append(result)
+    return result_list
+
+
+def stop_partitions(partition_process_list, partition_queue_list):
+    ''' the ones still running after a failure are waiting on the main process, so they are terminated '''
+    # rows still buffered for a stopped partition would otherwise block the exit
+    for partition_queue in partition_queue_list:
+        partition_queue.cancel_join_thread()
+    for process in partition_process_list:
+        if process.is_alive():
+            process.terminate()
+        process.join()
 
 
 def signal_handler(signal, frame):
@@ -468,20 +862,27 @@ if __name__ == "__main__":
     data_source = 'OPENC-OFFICER'
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input_file_name', dest='input_file_name', help='the name of an open corporates csv file for officers')
+    parser.add_argument('-i', '--input_file_name', dest='input_file_name', help='the name of an open corporates csv file for officers, or a directory or glob of its part files')
     parser.add_argument('-o', '--output_file_name', dest='output_file_name', help='the name of the output file')
     parser.add_argument('-t', '--temp_database_name', dest='temp_database_name', help='the name for the temporary database required to de-dupe officers')
     parser.add_argument('-d', '--data_source', dest='data_source', default=data_source, help='the name of the data source code to use, defaults to: ' + data_source)
     parser.add_argument('-l', '--log_file', dest='log_file', help='optional name of the statistics log file')
     parser.add_argument('-U', '--use_existing_db', dest='use_existing_db', action='store_true', default=False, help='use existing database, skips step 1')
+    parser.add_argument('-w', '--max_workers', type=int, help='defaults to the number of system processors, may need to reduce if running other things at same time')
+    parser.add_argument('-p', '--partitions', type=int, help='optional number of aggregator processes, each de-dupes its own range of hashes into its own temporary database and output file')
+    parser.add_argument('-k', '--cache_size', dest='cache_size', type=int, default=100000, help='the most values each process keeps in its normalization caches, 0 turns them off, defaults to 100000')
+    parser.add_argument('-T', '--slow_threshold', dest='slow_threshold', type=float, help='optional milliseconds above which an officer is reported as slow to map or rebuild with the time of each stage and its duplicate count')
+    parser.add_argument('-s', '--sample', dest='sample', type=float, help='optional fraction of the officers to map, chosen by their de-dupe hash so the same ones are chosen each time with all their duplicates')
+    parser.add_argument('-H', '--hash_algorithm', dest='hash_algorithm', choices=['md5', 'blake2b', 'xxhash'], default='md5', help='the de-dupe hash that becomes the record id, defaults to md5 which keeps the record ids of prior runs')
     args = parser.parse_args()
 
     if not args.output_file_name:
         print('\nPlease supply a valid output file name on the command line\n')
         sys.exit(1)
 
-    if not args.input_file_name or not os.path.exists(args.input_file_name):
-        print('\nPlease supply a valid input file name on the command line\n')
+    file_list = input_file_list(args.input_file_name) if args.input_file_name else []
+    if not args.use_existing_db and not file_list:
+        print('\nPlease supply a valid input file name, directory or glob on the command line\n')
         sys.exit(1)
 
     if not args.temp_database_name:
@@ -492,157 +893,182 @@ if __name__ == "__main__":
         os.remove(args.temp_database_name)
         #print(f"\n{dbname} already exists, please remove it first if you want to continue\n")
         #sys.exit(1)
-    mapper = mapper()
 
-    temp_dbo = make_database(args.temp_database_name, args.use_existing_db)
-    temp_dbo_cursor = temp_dbo.cursor()
+    if args.partitions and not 0 < args.partitions <= 256:
+        print('\nThe number of partitions must be between 1 and 256\n')
+        sys.exit(1)
+
+    if args.cache_size < 0:
+        print('\nThe cache size cannot be negative\n')
+        sys.exit(1)
+
+    if args.slow_threshold is not None and args.slow_threshold < 0:
+        print('\nThe slow threshold cannot be negative\n')
+        sys.exit(1)
+
+    if args.sample is not None and not 0 < args.sample <= 1:
+        print('\nThe sample must be a fraction greater than 0 and at most 1\n')
+        sys.exit(1)
+
+    if args.hash_algorithm == 'xxhash' and not xxhash:
+        print('\nThe xxhash module is not installed, pip install xxhash or choose another hash algorithm\n')
+        sys.exit(1)
+
+    if args.use_existing_db and not args.partitions:
+        if not check_database(args.temp_database_name):
+            sys.exit(1)
+
+    officer_mapper = mapper(args.data_source)
+
+    process_count = args.max_workers if args.max_workers else multiprocessing.cpu_count()
+    batch_size = 10000
 
     input_row_count = 0
     output_row_count = 0
 
-    file_name = args.input_file_name
-    base_file_name, file_extension = os.path.splitext(file_name)
-    compressed_file = file_extension.upper() == '.GZ'
-    if compressed_file:
-        base_file_name, file_extension = os.path.splitext(base_file_name)
-        input_file_handle = gzip.open(file_name, 'r')
-        csv_reader = csv.DictReader(io.TextIOWrapper(io.BufferedReader(input_file_handle), encoding='utf-8', errors='ignore'))
-    else:
-        input_file_handle = open(file_name, 'r')
-        csv_reader = csv.DictReader(input_file_handle, dialect='excel')
-
     # for de-dupe
     hashes_mapped = {}
 
-    # to cache multiple updates to same hash
-    hash_duplicates = {}
+    # in partition mode each aggregator process owns the hash prefixes where prefix % partitions = its number
+    partition_process_list = []
+    partition_queue_list = []
+    if args.partitions:
+        result_queue = multiprocessing.Queue()
+        stop_writing = multiprocessing.Value('i', 0)
+        kwargs = {'data_source': args.data_source,
+                  'temp_database_name': args.temp_database_name,
+                  'output_file_name': args.output_file_name,
+                  'use_existing_db': args.use_existing_db,
+                  'partitions': args.partitions,
+                  'slow_threshold': args.slow_threshold,
+                  'stop_writing': stop_writing}
+        for partition_number in range(args.partitions):
+            partition_queue_list.append(multiprocessing.Queue(process_count * 4))
+            partition_process_list.append(multiprocessing.Process(target=aggregate_partition, args=(partition_number, partition_queue_list[-1], result_queue), kwargs=kwargs))
+        for process in partition_process_list:
+            process.start()
 
     # step 1 - reading
     if not args.use_existing_db:
-        print (f'\nStep 1: Mapping {file_name} ...\n')
+        if not args.partitions:
+            temp_dbo = make_database(args.temp_database_name, args.use_existing_db)
+
+        # the workers compile a column plan against each file's header, the rows are sent as lists
+        header_list = []
+        for file_name in file_list:
+            input_file_handle, csv_reader, header = open_csv_file(file_name)
+            input_file_handle.close()
+            header_list.append(header)
+            missing_columns = [x for x in officer_source_columns + [x[0] for x in officer_column_mappings] if x not in header]
+            if missing_columns:
+                print(f"\nwarning: {', '.join(sorted(set(missing_columns)))} not in {file_name}, mapped as empty")
+
+        file_name = file_list[0] if len(file_list) == 1 else f'{len(file_list)} files'
+        print (f'\nStep 1: Mapping {file_name} with {process_count} processes ...\n')
+        if args.sample is not None:
+            print(f"sampling {args.sample:.2%} of the officers by their de-dupe hash\n")
+        sampled_row_count = 0
+        partition_failed = False
         batch_start_time = time.time()
 
-        input_row_count, input_row = safe_csv_next(csv_reader, input_row_count)
-        while input_row:
-            json_data = mapper.map(input_row)
-            if json_data:
-
-                # extract attributes for compression
-                record_id = json_data['RECORD_ID']
-                rel_data = json_data['RELATIONSHIPS'][0]
-                base_json_data = dict(json_data)
-                del base_json_data['RECORD_ID']
-                del base_json_data['RELATIONSHIPS']
-                record_hash = hashlib.md5(orjson.dumps(base_json_data, option=orjson.OPT_SORT_KEYS)).hexdigest()
-
-                if record_hash not in hashes_mapped:
-                    hashes_mapped[record_hash] = 1
-                    temp_dbo_cursor.execute('INSERT INTO hashes VALUES (?, ?)', (record_hash, orjson.dumps(json_data).decode()))
+        # workers map and hash, this process (or the partition processes) owns the hashes and the database
+        with multiprocessing.Pool(process_count, initializer=init_worker, initargs=(args.data_source, header_list, args.hash_algorithm, args.cache_size, args.slow_threshold, args.sample)) as pool:
+            for row_count, mapped_list, stat_pack in bounded_imap(pool, map_rows, parallel_batch_reader(file_list, batch_size, lambda: shut_down), process_count * 4):
+                officer_mapper.merge_stats(stat_pack)
+                sampled_row_count += len(mapped_list)
+
+                if args.partitions:
+                    partitioned_lists = [[] for partition_number in range(args.partitions)]
+                    for mapped_data in mapped_list:
+                        partitioned_lists[mapped_data[0][0] % args.partitions].append(mapped_data)
+                    for partition_number in range(args.partitions):
+                        if partitioned_lists[partition_number]:
+                            if not put_partition_queue(partition_queue_list[partition_number], partition_process_list[partition_number], partitioned_lists[partition_number]):
+                                partition_failed = True
+                    # the partitions only stop in step 1 when they fail
+                    if partition_failed or not all(process.is_alive() for process in partition_process_list):
+                        partition_failed = True
+                        break
                 else:
-                    if record_hash not in hash_duplicates: # cache updates
-                        hash_duplicates[record_hash] = []
-                    hash_duplicates[record_hash].append([record_id, rel_data])
+                    save_mapped_list(temp_dbo, hashes_mapped, mapped_list)
+
+                prior_row_count = input_row_count
+                input_row_count += row_count
+                if input_row_count // 100000 > prior_row_count // 100000:
+                    batch_seconds = round(time.time() - batch_start_time, 1)
+                    total_minutes = round((time.time() - proc_start_time) / 60, 1)
+                    if args.partitions:
+                        print(f"{input_row_count:,} rows read after {total_minutes:,} minutes, batch rate {batch_seconds} seconds")
+                    else:
+                        temp_dbo.commit()
+                        print(f"{input_row_count:,} rows read, {len(hashes_mapped):,} unique hashes processed after {total_minutes:,} minutes, batch rate {batch_seconds} seconds")
+                    batch_start_time = time.time()
+
+        if not args.partitions:
+            finish_database(temp_dbo, not shut_down)
+            temp_dbo.close()
+
+            elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
+            run_status = ('completed in' if not shut_down else 'aborted after') + f" {elapsed_mins:,} minutes"
+            print(f"{input_row_count:,} rows read, {len(hashes_mapped):,} unique hashes {run_status}\n")
+
+        if args.sample is not None:
+            print(f"{sampled_row_count:,} rows sampled\n")
+
+        for cache_name, (hit_rate, lookup_count) in cache_hit_rates(officer_mapper.stat_pack).items():
+            print(f"{cache_name.lower().replace('_', ' ')} cache hit rate {hit_rate:.1%} of {lookup_count:,} lookups")
+
+        if partition_failed:
+            partition_results(result_queue, partition_process_list)
+            stop_partitions(partition_process_list, partition_queue_list)
+            print('\nThe run was ended as a partition failed\n')
+            sys.exit(1)
+
+        # an empty list tells the partitions step 1 was aborted
+        for partition_number in range(len(partition_queue_list)):
+            put_partition_queue(partition_queue_list[partition_number], partition_process_list[partition_number], [] if shut_down else None)
 
-            if input_row_count % 100000 == 0:
-                temp_dbo.commit()
-                batch_seconds = round(time.time() - batch_start_time, 1)
-                total_minutes = round((time.time() - proc_start_time) / 60, 1)
-                print(f"{input_row_count:,} rows read, {len(hashes_mapped):,} unique hashes processed after {total_minutes:,} minutes, batch rate {batch_seconds} seconds")
-                batch_start_time = time.time()
+    # step 2 - output
+    if args.partitions:
+        shut_down = False
+        print (f'\nStep 2: Writing {args.partitions} partitions of {args.output_file_name} ...\n')
+        write_start_time = time.time()
 
-            if shut_down:
-                break
+        result_list = partition_results(result_queue, partition_process_list, stop_writing)
+        if result_list is None:
+            stop_partitions(partition_process_list, partition_queue_list)
+            print('\nThe run was ended as a partition failed\n')
+            sys.exit(1)
+        for process in partition_process_list:
+            process.join()
 
-            input_row_count, input_row = safe_csv_next(csv_reader, input_row_count)
+        unique_hash_count = 0
+        for partition_number, partition_hash_count, partition_row_count, stat_pack, error in result_list:
+            unique_hash_count += partition_hash_count
+            output_row_count += partition_row_count
+            officer_mapper.merge_stats(stat_pack)
 
-        temp_dbo.commit()
-        elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
+        elapsed_mins = round((time.time() - write_start_time) / 60, 1)
+        if not args.use_existing_db:
+            print(f"{input_row_count:,} rows read, {unique_hash_count:,} unique hashes")
         run_status = ('completed in' if not shut_down else 'aborted after') + f" {elapsed_mins:,} minutes"
-        print(f"{input_row_count:,} rows read, {len(hashes_mapped):,} unique hashes {run_status}\n")
-        input_file_handle.close()
+        print(f"{output_row_count:,} rows written to {args.partitions} partitions {run_status}\n")
 
-    # step 2 - output
-    if True: #not shut_down (for testing you may want to stop step 1 and still generate json in step 2
+        elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
+        print(f"process {('completed in' if not shut_down else 'aborted after')} {elapsed_mins:,} minutes\n")
+
+    else: #not shut_down (for testing you may want to stop step 1 and still generate json in step 2
         shut_down = False
 
         output_file_name = args.output_file_name
-        if output_file_name.endswith('.gz'):
-            output_file_handle = gzip.open(output_file_name, 'wb')
-        else:
-            output_file_handle = open(output_file_name, 'w', encoding='utf-8')
-
-        print (f'\nStep 2: Writing {output_file_name} ...\n')
+        print (f'\nStep 2: Writing {output_file_name} with {process_count} processes ...\n')
         write_start_time = time.time()
-        batch_start_time = time.time()
-        batch_records = []
-
-        temp_dbo_cursor.execute('select hash, base_json from hashes')
-        record = temp_dbo_cursor.fetchone()
-        while record:
-            record_hash = record[0]
-            new_json_data = orjson.loads(record[1])
-
-            record_list = [new_json_data['RECORD_ID']]
-            relation_data = new_json_data['RELATIONSHIPS'][0]
-            relations_by_role = {relation_data['REL_POINTER_ROLE']: [relation_data]}
-            if record_hash in hash_duplicates:
-                for additional_data in hash_duplicates[record_hash]:
-                    record_list.append(additional_data[0])
-                    relation_data = additional_data[1]
-                    if relation_data['REL_POINTER_ROLE'] not in relations_by_role:
-                        relations_by_role[relation_data['REL_POINTER_ROLE']] = []
-                    relations_by_role[relation_data['REL_POINTER_ROLE']].append(relation_data)
-
-            new_json_data['RECORD_ID'] = record_hash
-            new_json_data['RECORD_COUNT'] = len(record_list)
-            if new_json_data['RECORD_COUNT'] > 10000:
-                mapper.update_stat('_FYI', "RECORD_HASH>10000", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}")
-            elif new_json_data['RECORD_COUNT'] > 1000:
-                mapper.update_stat('_FYI', "RECORD_HASH>1000", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}")
-            elif new_json_data['RECORD_COUNT'] > 100:
-                mapper.update_stat('_FYI', "RECORD_HASH>100", f"{new_json_data['RECORD_ID']}={new_json_data['RECORD_COUNT']}")
-            if new_json_data['RECORD_COUNT'] < 4:
-                new_json_data['RECORD_IDS'] = ' | '.join(record_list)
-            else:
-                new_json_data['RECORD_IDS'] = ' | '.join(sorted(record_list[0:3])) + f" | + {len(record_list)-3} more"
-            new_json_data['RECORD_LIST'] = [{'id': x} for x in record_list[0:max_records_per_entity]] # cap so egregious offenders don't slow down the system
-
-            relation_list = []
-            for role in relations_by_role:
-                if len(relations_by_role[role]) > max_relationships_per_role:
-                    mapper.update_stat('_FYI', f"ROLE-{role}-SUPPRESSED", f"{new_json_data['RECORD_ID']}={len(relations_by_role[role])}")
-                    new_json_data[f"Suppressed {role} relationships"] = len(relations_by_role[role])
-                else:
-                    relation_list.extend(relations_by_role[role])
-            if relation_list:
-                new_json_data['RELATIONSHIPS'] = relation_list
-
-            if output_file_name.endswith('.gz'):
-                batch_records.append((orjson.dumps(new_json_data).decode()+'\n').encode('utf-8'))
-            else:
-                batch_records.append((orjson.dumps(new_json_data).decode()+'\n'))
-            output_row_count += 1
-
-            if output_row_count % 1000000 == 0:
-                elapsed_seconds = round(time.time() - batch_start_time, 1)
-                print(f"{output_row_count:,} rows written in {elapsed_seconds:,} seconds")
-                batch_start_time = time.time()
-
-            # separated from progress interval to create even more randomness
-            if output_row_count % 10000000 == 0:
-                random.shuffle(batch_records)
-                output_file_handle.writelines(batch_records)
-                batch_records = []
 
-            if shut_down:
-                break
+        # disjoint hash ranges are rebuilt concurrently
+        task_list = hash_range_tasks(args.temp_database_name, output_file_name, slow_threshold=args.slow_threshold)
 
-            record = temp_dbo_cursor.fetchone()
-
-        if batch_records:
-            random.shuffle(batch_records)
-            output_file_handle.writelines(batch_records)
-        output_file_handle.close()
+        with multiprocessing.Pool(process_count, initializer=init_worker, initargs=(args.data_source,)) as pool:
+            output_row_count = write_hash_ranges(output_file_name, bounded_imap(pool, build_hash_range, task_list, process_count * 2), officer_mapper, lambda: shut_down)
 
         elapsed_mins = round((time.time() - write_start_time) / 60, 1)
         run_status = ('completed in' if not shut_down else 'aborted after') + f" {elapsed_mins:,} minutes"
@@ -651,11 +1077,10 @@ if __name__ == "__main__":
         elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
         print(f"process {('completed in' if not shut_down else 'aborted after')} {elapsed_mins:,} minutes\n")
 
-
     # write statistics file
     if args.log_file: 
         with open(args.log_file, 'w') as outfile:
-            outfile.write(orjson.dumps(mapper.stat_pack, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode())
+            outfile.write(orjson.dumps(officer_mapper.stat_pack, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode())
         print('Mapping stats written to %s\n' % args.log_file)
 
     sys.exit(0)
@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+
+import sys
+import argparse
+import time
+import signal
+import hashlib
+import math
+import orjson
+import multiprocessing
+
+from openc_common import bounded_imap, input_file_list, open_csv_file, parallel_batch_reader
+
+# the distinct counts are estimated with 2**12 registers per column, a standard error of about 1.6%
+hll_precision = 12
+
+# a column keeps its value hashes rather than the 4k of registers until it has this many, so a batch's small jurisdictions are cheap to send back
+hll_sparse_limit = 256
+
+# the space saving counters track this many candidates for each top value reported
+top_value_candidates = 20
+
+shut_down = False
+
+
+class distinct_counter():
+    ''' a hyperloglog estimate of the number of distinct values, merged by taking the larger register, exact while it is sparse '''
+
+    def __init__(self, precision=hll_precision):
+        self.precision = precision
+        self.rank_mask = (1 << (64 - precision)) - 1
+        self.hashes = set()
+        self.registers = None
+
+    def add(self, value):
+        hash_value = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+        if self.registers is None:
+            self.hashes.add(hash_value)
+            if len(self.hashes) > hll_sparse_limit:
+                self.make_dense()
+        else:
+            self.add_hash(hash_value)
+
+    def add_hash(self, hash_value):
+        register = hash_value >> (64 - self.precision)
+        rank = (64 - self.precision) - (hash_value & self.rank_mask).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def make_dense(self):
+        self.registers = bytearray(1 << self.precision)
+        for hash_value in self.hashes:
+            self.add_hash(hash_value)
+        self.hashes = None
+
+    def merge(self, other):
+        if other.registers is None:
+            if self.registers is None:
+                self.hashes |= other.hashes
+                if len(self.hashes) > hll_sparse_limit:
+                    self.make_dense()
+            else:
+                for hash_value in other.hashes:
+                    self.add_hash(hash_value)
+            return
+        if self.registers is None:
+            self.make_dense()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        if self.registers is None:
+            return len(self.hashes)
+        register_count = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / register_count)
+        estimate = alpha * register_count * register_count / sum(2.0 ** -rank for rank in self.registers)
+        zero_count = self.registers.count(0)
+        if estimate <= 2.5 * register_count and zero_count: # linear counting is closer for the small ones
+            estimate = register_count * math.log(register_count / zero_count)
+        return round(estimate)
+
+
+class top_values():
+    ''' space saving counts of the most frequent values, trimmed back to capacity whenever it doubles '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {} # how much of a value's count may be from before it was kept
+        self.floor = 0 # the highest count trimmed, a new value may have been seen that often before
+
+    def add(self, value):
+        if value in self.counts:
+            self.counts[value] += 1
+        else:
+            self.counts[value] = self.floor + 1
+            if self.floor:
+                self.errors[value] = self.floor
+            if len(self.counts) >= self.capacity * 2:
+                self.trim()
+
+    def trim(self):
+        count_list = sorted(self.counts.items(), key=lambda x: (-x[1], x[0])) # ties are kept by value so every run trims the same
+        self.floor = max(self.floor, count_list[self.capacity][1])
+        self.counts = dict(count_list[:self.capacity])
+        self.errors = {value: error for value, error in self.errors.items() if value in self.counts}
+
+    def merge(self, other):
+        # a value trimmed from (or never kept by) one side may have been seen up to its floor there
+        counts = {}
+        errors = {}
+        for value in self.counts.keys() | other.counts.keys():
+            counts[value] = self.counts.get(value, self.floor) + other.counts.get(value, other.floor)
+            error = (self.errors.get(value, 0) if value in self.counts else self.floor) + (other.errors.get(value, 0) if value in other.counts else other.floor)
+            if error:
+                errors[value] = error
+        self.counts = counts
+        self.errors = errors
+        self.floor += other.floor
+        if len(self.counts) >= self.capacity * 2:
+            self.trim()
+
+    def top(self, count):
+        ''' the most frequent values with the counts they are certain to have, exact until the first trim '''
+        return sorted(((value, value_count - self.errors.get(value, 0)) for value, value_count in self.counts.items()), key=lambda x: (-x[1], x[0]))[:count]
+
+
+class column_profile():
+
+    def __init__(self, top_count):
+        self.populated_count = 0
+        self.distinct_values = distinct_counter()
+        self.top_values = top_values(top_count * top_value_candidates)
+
+    def add(self, value):
+        self.populated_count += 1
+        self.distinct_values.add(value)
+        self.top_values.add(value)
+
+    def merge(self, other):
+        self.populated_count += other.populated_count
+        self.distinct_values.merge(other.distinct_values)
+        self.top_values.merge(other.top_values)
+
+
+class data_profile():
+    ''' the column profiles of all the rows, or of one jurisdiction's '''
+
+    def __init__(self, top_count):
+        self.top_count = top_count
+        self.row_count = 0
+        self.columns = {}
+
+    def column(self, column_name):
+        if column_name not in self.columns:
+            self.columns[column_name] = column_profile(self.top_count)
+        return self.columns[column_name]
+
+    def merge(self, other):
+        self.row_count += other.row_count
+        for column_name, profile in other.columns.items():
+            self.column(column_name).merge(profile)
+
+    def report(self, column_list):
+        ''' the statistics of each column in the order given '''
+        report_data = {'row_count': self.row_count, 'columns': {}}
+        for column_name in column_list:
+            profile = self.columns.get(column_name, column_profile(self.top_count))
+            distinct_count = min(profile.distinct_values.estimate(), profile.populated_count)
+            report_data['columns'][column_name] = {
+                'populated_percent': round(profile.populated_count / self.row_count * 100, 2) if self.row_count else 0.0,
+                'unique_percent': round(distinct_count / profile.populated_count * 100, 2) if profile.populated_count else 0.0,
+                'populated_count': profile.populated_count,
+                'distinct_count': distinct_count,
+                'top_values': [{'value': value, 'count': count} for value, count in profile.top_values.top(self.top_count)]}
+        return report_data
+
+
+def clean_value(raw_value):
+    ''' the mappers' clean_value rules '''
+    if not raw_value:
+        return ''
+    new_value = ' '.join(str(raw_value).strip().split())
+    if new_value.upper() in ['NULL', 'NUL', 'N/A']:
+        return ''
+    return new_value
+
+
+def init_worker(header_list, top_count, by_jurisdiction):
+    ''' each worker process profiles the batches it is sent, the main process handles the interrupt '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global worker_header_list, worker_top_count, worker_by_jurisdiction
+    worker_header_list = header_list
+    worker_top_count = top_count
+    worker_by_jurisdiction = by_jurisdiction
+
+
+def profile_rows(task):
+    ''' profiles a batch of rows from one input file, returns the profiles keyed by jurisdiction with all the rows under None '''
+    file_number, row_list = task
+    header = worker_header_list[file_number]
+    jurisdiction_position = header.index('jurisdiction_code') if worker_by_jurisdiction else None
+    profiles = {None: data_profile(worker_top_count)}
+    for raw_row in row_list:
+        profile_list = [profiles[None]]
+        if worker_by_jurisdiction:
+            jurisdiction_code = clean_value(raw_row[jurisdiction_position]) if jurisdiction_position < len(raw_row) else ''
+            if jurisdiction_code not in profiles:
+                profiles[jurisdiction_code] = data_profile(worker_top_count)
+            profile_list.append(profiles[jurisdiction_code])
+        for profile in profile_list:
+            profile.row_count += 1
+        for column_name, raw_value in zip(header, raw_row):
+            value = clean_value(raw_value)
+            if value:
+                for profile in profile_list:
+                    profile.column(column_name).add(value)
+    return len(row_list), profiles
+
+
+def print_report(column_list, report_data):
+    ''' in the form of the column notes in the mappers '''
+    for column_name in column_list:
+        column_data = report_data['columns'][column_name]
+        print(f"        # columnName: {column_name}")
+        print(f"        # {column_data['populated_percent']} populated, {column_data['unique_percent']} unique")
+        for top_value in column_data['top_values']:
+            print(f"        #      {top_value['value']} ({top_value['count']})")
+        print()
+
+
+def signal_handler(signal, frame):
+    print('USER INTERUPT! Shutting down ... (please wait)')
+    global shut_down
+    shut_down = True
+    return
+
+
+if __name__ == "__main__":
+    proc_start_time = time.time()
+    shut_down = False
+    signal.signal(signal.SIGINT, signal_handler)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_file_name', dest='input_file_name', help='the name of an open corporates companies, officers or child csv file, or a directory or glob of its part files')
+    parser.add_argument('-o', '--output_file_name', dest='output_file_name', help='optional name of a json file for the profile')
+    parser.add_argument('-j', '--by_jurisdiction', dest='by_jurisdiction', action='store_true', default=False, help='also profile each jurisdiction on its own')
+    parser.add_argument('-k', '--top_count', dest='top_count', type=int, default=5, help='the number of most frequent values reported for each column, defaults to 5')
+    parser.add_argument('-w', '--max_workers', type=int, help='defaults to the number of system processors, may need to reduce if running other things at same time')
+    args = parser.parse_args()
+
+    file_list = input_file_list(args.input_file_name) if args.input_file_name else []
+    if not file_list:
+        print('\nPlease supply a valid input file name, directory or glob on the command line\n')
+        sys.exit(1)
+
+    if args.top_count < 1:
+        print('\nThe top count must be at least 1\n')
+        sys.exit(1)
+
+    # the profile is by column name, so the parts do not need the same column order
+    header_list = []
+    column_list = []
+    for file_name in file_list:
+        input_file_handle, csv_reader, header = open_csv_file(file_name)
+        input_file_handle.close()
+        header_list.append(header)
+        column_list.extend(x for x in header if x not in column_list)
+        if args.by_jurisdiction and 'jurisdiction_code' not in header:
+            print(f'\n{file_name} has no jurisdiction_code column to profile by\n')
+            sys.exit(1)
+
+    process_count = args.max_workers if args.max_workers else multiprocessing.cpu_count()
+    batch_size = 10000
+
+    file_name = file_list[0] if len(file_list) == 1 else f'{len(file_list)} files'
+    print(f'\nProfiling {file_name} with {process_count} processes ...\n')
+
+    # the workers profile each batch with their own sketches and this process merges them
+    profiles = {None: data_profile(args.top_count)}
+    input_row_count = 0
+    batch_start_time = time.time()
+    with multiprocessing.Pool(process_count, initializer=init_worker, initargs=(header_list, args.top_count, args.by_jurisdiction)) as pool:
+        for row_count, batch_profiles in bounded_imap(pool, profile_rows, parallel_batch_reader(file_list, batch_size, lambda: shut_down), process_count * 4):
+            for jurisdiction_code, profile in batch_profiles.items():
+                if jurisdiction_code not in profiles:
+                    profiles[jurisdiction_code] = data_profile(args.top_count)
+                profiles[jurisdiction_code].merge(profile)
+
+            prior_row_count = input_row_count
+            input_row_count += row_count
+            if input_row_count // 1000000 > prior_row_count // 1000000:
+                batch_seconds = round(time.time() - batch_start_time, 1)
+                total_minutes = round((time.time() - proc_start_time) / 60, 1)
+                print(f"{input_row_count:,} rows read after {total_minutes:,} minutes, batch rate {batch_seconds} seconds")
+                batch_start_time = time.time()
+
+    report_data = profiles[None].report(column_list)
+    print_report(column_list, report_data)
+    if args.by_jurisdiction:
+        report_data['jurisdictions'] = {}
+        for jurisdiction_code in sorted(x for x in profiles if x is not None):
+            report_data['jurisdictions'][jurisdiction_code] = profiles[jurisdiction_code].report(column_list)
+            print(f"jurisdiction {jurisdiction_code or '(none)'}: {profiles[jurisdiction_code].row_count:,} rows\n")
+            print_report(column_list, report_data['jurisdictions'][jurisdiction_code])
+
+    if args.output_file_name:
+        with open(args.output_file_name, 'w') as outfile:
+            outfile.write(orjson.dumps(report_data, option=orjson.OPT_INDENT_2).decode())
+        print(f'Profile written to {args.output_file_name}\n')
+
+    elapsed_mins = round((time.time() - proc_start_time) / 60, 1)
+    run_status = ('completed in' if not shut_down else 'aborted after') + f" {elapsed_mins:,} minutes"
+    print(f"{input_row_count:,} rows profiled {run_status}\n")
+
+    sys.exit(0)
@@ -0,0 +1,315 @@
+''' the input readers and mapping helpers shared by openc-companies.py, openc-officers.py and openc-profile.py, which import it from their own directory '''
+
+import os
+import sys
+import glob
+import csv
+import gzip
+import io
+import threading
+import collections
+import hashlib
+import signal
+import time
+import multiprocessing
+from queue import Empty, Full, Queue
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# the most parts read at the same time, fixed so the order the batches come in does not depend on the number of workers
+part_reader_count = 4
+
+
+def bounded_imap(pool, function_ref, task_iterator, max_pending):
+    ''' like pool.imap, but only reads ahead max_pending tasks so the input is not all pulled into memory '''
+    pending = collections.deque()
+    for task in task_iterator:
+        pending.append(pool.apply_async(function_ref, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class gzip_reader(io.RawIOBase):
+    ''' inflates a gzip file in a background thread, reading ahead into a bounded queue of blocks for the csv parser '''
+
+    def __init__(self, file_name, block_size=1048576, block_count=16):
+        self.block_queue = Queue(block_count)
+        self.block = memoryview(b'')
+        self.eof = False
+        self.inflate_thread = threading.Thread(target=self.inflate, args=(file_name, block_size), daemon=True)
+        self.inflate_thread.start()
+
+    def inflate(self, file_name, block_size):
+        # zlib releases the gil, so this overlaps the parsing
+        try:
+            with gzip.open(file_name, 'rb') as file_handle:
+                block = file_handle.read(block_size)
+                while block and self.put_block(block):
+                    block = file_handle.read(block_size)
+            self.put_block(b'')
+        except Exception as err:
+            self.put_block(err)
+
+    def put_block(self, block):
+        ''' waits for room in the queue, returns False once the reader is closed '''
+        while not self.closed:
+            try:
+                self.block_queue.put(block, True, 1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.block and not self.eof:
+            block = self.block_queue.get()
+            if isinstance(block, Exception):
+                raise block
+            self.block = memoryview(block)
+            self.eof = not block
+        byte_count = min(len(buffer), len(self.block))
+        buffer[0:byte_count] = self.block[0:byte_count]
+        self.block = self.block[byte_count:]
+        return byte_count
+
+    def close(self):
+        super().close()
+        self.inflate_thread.join()
+
+
+def input_file_list(input_file_name):
+    ''' a single file, a directory of csv part files or a glob of them '''
+    if os.path.isdir(input_file_name):
+        return sorted(x for x in glob.glob(os.path.join(glob.escape(input_file_name), '*')) if x.upper().endswith(('.CSV', '.CSV.GZ')))
+    if os.path.isfile(input_file_name):
+        return [input_file_name]
+    return sorted(x for x in glob.glob(input_file_name) if os.path.isfile(x))
+
+
+def open_csv_file(file_name):
+    ''' returns the file handle and a csv reader positioned after the header, and the header '''
+    if os.path.splitext(file_name)[1].upper() == '.GZ':
+        input_file_handle = gzip_reader(file_name)
+        csv_reader = csv.reader(io.TextIOWrapper(io.BufferedReader(input_file_handle), encoding='utf-8', errors='ignore'))
+    else:
+        input_file_handle = open(file_name, 'r')
+        csv_reader = csv.reader(input_file_handle, dialect='excel')
+    return input_file_handle, csv_reader, next(csv_reader, [])
+
+
+def csv_batch_reader(file_list, batch_size, stopped=lambda: False):
+    ''' the batches of rows from each file in turn, tagged with the file's number, until stopped returns True '''
+    for file_number in range(len(file_list)):
+        input_file_handle, csv_reader, header = open_csv_file(file_list[file_number])
+        if len(file_list) > 1:
+            print(f"reading {file_list[file_number]}")
+        row_count = 0
+        row_list = []
+        row_count, input_row = safe_csv_next(csv_reader, row_count)
+        while input_row:
+            row_list.append(input_row)
+            if len(row_list) == batch_size:
+                yield file_number, row_list
+                row_list = []
+            if stopped():
+                break
+            row_count, input_row = safe_csv_next(csv_reader, row_count)
+        if row_list:
+            yield file_number, row_list
+        input_file_handle.close()
+        if stopped():
+            break
+
+
+def parallel_batch_reader(file_list, batch_size, stopped=lambda: False):
+    ''' like csv_batch_reader, but the parts are shared out between reader processes that read them at the same time
+
+        the readers' batches are taken in turn, so they come in the same order every run and the officers de-dupe the same way '''
+    reader_count = min(part_reader_count, len(file_list))
+    if reader_count < 2:
+        yield from csv_batch_reader(file_list, batch_size, stopped)
+        return
+    stop_reading = multiprocessing.Value('i', 0)
+    readers = []
+    for reader_number in range(reader_count):
+        part_list = [(file_number, file_list[file_number]) for file_number in range(reader_number, len(file_list), reader_count)]
+        batch_queue = multiprocessing.Queue(4)
+        process = multiprocessing.Process(target=read_parts, args=(part_list, batch_size, batch_queue, stop_reading))
+        process.start()
+        readers.append((process, batch_queue))
+    error = None
+    try:
+        while readers:
+            for reader in list(readers):
+                file_number, row_list = next_batch(*reader)
+                if file_number is None: # the reader has finished its parts, or failed
+                    readers.remove(reader)
+                    reader[0].join()
+                    if row_list:
+                        error = error or row_list
+                        stop_reading.value = 1
+                    continue
+                # the batches still queued after a stop are dropped while the readers finish
+                if not stop_reading.value:
+                    yield file_number, row_list
+                    if stopped():
+                        stop_reading.value = 1
+    finally:
+        stop_reading.value = 1
+        for process, batch_queue in readers:
+            process.terminate()
+            process.join()
+    if error:
+        raise RuntimeError(error)
+
+
+def next_batch(process, batch_queue):
+    ''' a reader that ends normally has always sent its end, one that was killed or crashed has not '''
+    while True:
+        try:
+            return batch_queue.get(True, 1)
+        except Empty:
+            if process.exitcode not in (None, 0):
+                return None, f"reader stopped with exit code {process.exitcode}"
+
+
+def read_parts(part_list, batch_size, batch_queue, stop_reading):
+    ''' a reader process, sends the batches of rows of its parts in turn and then (None, None), or (None, the error that stopped it) '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    end_message = (None, None)
+    for file_number, file_name in part_list:
+        if stop_reading.value:
+            break
+        print(f"reading {file_name}")
+        try:
+            input_file_handle, csv_reader, header = open_csv_file(file_name)
+            row_list = []
+            row_count, input_row = safe_csv_next(csv_reader, 0)
+            while input_row and not stop_reading.value:
+                row_list.append(input_row)
+                if len(row_list) == batch_size:
+                    batch_queue.put((file_number, row_list))
+                    row_list = []
+                row_count, input_row = safe_csv_next(csv_reader, row_count)
+            if row_list and not stop_reading.value:
+                batch_queue.put((file_number, row_list))
+            input_file_handle.close()
+        except Exception as err:
+            end_message = (None, f'{file_name} {type(err).__name__}: {err}')
+            break
+    batch_queue.put(end_message)
+
+
+def safe_csv_next(reader, counter):
+    ''' returns the count of rows read and the next row, or None at the end '''
+    while True:
+        try:
+            counter += 1
+            input_row = next(reader)
+            while not input_row: # blank lines are skipped as the dict reader did
+                input_row = next(reader)
+            return counter, input_row
+        except StopIteration:
+            return counter, None
+        except Exception as err:
+            counter += 1
+            print(f"error: row {counter} {err}")
+
+
+class column_plan():
+    ''' the column mappings compiled once against the file's header and run against the positional csv rows '''
+
+    def __init__(self, header, source_columns, column_mappings, column_transforms, clean_function, excluded_columns=(), cached_columns=(), cached_clean_function=None):
+        # a column missing from the file or excluded reads as empty without being cleaned, an excluded mapping is dropped
+        header_positions = {column_name: position for position, column_name in enumerate(header) if column_name not in excluded_columns}
+        column_mappings = [x for x in column_mappings if x[0] not in excluded_columns]
+        column_list = source_columns + [x[0] for x in column_mappings]
+        self.positions = [header_positions.get(column_name, sys.maxsize) for column_name in column_list]
+        self.source_count = len(source_columns)
+        self.steps = [(attribute, column_transforms[transform] if transform else None, destination == 'payload') for column_name, attribute, transform, destination in column_mappings]
+        self.clean_functions = [cached_clean_function if cached_clean_function and column_name in cached_columns else clean_function for column_name in column_list]
+
+    def read(self, raw_row):
+        ''' the cleaned values of the source columns followed by the mapped ones '''
+        row_length = len(raw_row)
+        return [clean_function(raw_row[position]) if position < row_length else '' for position, clean_function in zip(self.positions, self.clean_functions)]
+
+    def apply(self, values, json_data, payload_data):
+        for value, (attribute, transform, is_payload) in zip(values[self.source_count:], self.steps):
+            (payload_data if is_payload else json_data)[attribute] = transform(value) if transform else value
+
+
+class record_tracer():
+    ''' times the stages of mapping a record and reports the ones slower than the threshold '''
+
+    def __init__(self, label, slow_threshold):
+        self.label = label
+        self.slow_threshold = slow_threshold / 1000 # given in milliseconds
+        self.stage_times = {}
+        self.row_counts = {}
+
+    def start(self):
+        self.stage_times = {}
+        self.row_counts = {}
+        self.start_time = self.stage_start = time.perf_counter()
+
+    def stage(self, stage_name):
+        stage_end = time.perf_counter()
+        self.stage_times[stage_name] = stage_end - self.stage_start
+        self.stage_start = stage_end
+
+    def rows(self, table_name, row_count):
+        self.row_counts[table_name] = row_count
+
+    def finish(self, record_id):
+        ''' returns the stat update for a slow record, None for the rest '''
+        elapsed_time = self.stage_start - self.start_time # to the end of the last stage
+        if elapsed_time < self.slow_threshold:
+            return None
+        slowest_stage = max(self.stage_times, key=self.stage_times.get)
+        stage_text = ', '.join(f'{stage_name} {stage_time * 1000:.1f}ms' for stage_name, stage_time in self.stage_times.items())
+        row_text = ', '.join(f'{table_name} {row_count:,}' for table_name, row_count in self.row_counts.items()) or 'none'
+        print(f"{self.label} slow record {record_id} took {elapsed_time * 1000:.1f}ms ({stage_text}) with rows: {row_text}")
+        return ['_SLOW_RECORDS', slowest_stage.upper(), f'{record_id} | {elapsed_time * 1000:.1f}ms | {row_text}']
+
+
+def record_hasher(hash_algorithm):
+    ''' the binary digest of a record's json, each mapper's -H sets its own default '''
+    if hash_algorithm == 'md5':
+        return lambda data: hashlib.md5(data).digest()
+    if hash_algorithm == 'xxhash':
+        return xxhash.xxh3_128_digest
+    return lambda data: hashlib.blake2b(data, digest_size=16).digest()
+
+
+def cache_stat_updates(caches, cache_counts):
+    ''' the hits and misses of each cache since the last call as _CACHE stat updates with their counts, to be summed across the processes '''
+    stat_update_list = []
+    for cache_name, cache_function in caches.items():
+        cache_info = cache_function.cache_info()
+        prior_hits, prior_misses = cache_counts.get(cache_name, (0, 0))
+        cache_counts[cache_name] = (cache_info.hits, cache_info.misses)
+        stat_update_list.append(['_CACHE', f'{cache_name}_HITS', None, cache_info.hits - prior_hits])
+        stat_update_list.append(['_CACHE', f'{cache_name}_MISSES', None, cache_info.misses - prior_misses])
+    return stat_update_list
+
+
+def cache_hit_rates(stat_pack):
+    ''' the hit rate and lookup count of each cache from the summed _CACHE stats '''
+    cache_stats = stat_pack.get('_CACHE', {})
+    hit_rates = {}
+    for stat_name in cache_stats:
+        if stat_name.endswith('_HITS'):
+            cache_name = stat_name[:-5]
+            hit_count = cache_stats[stat_name]['count']
+            lookup_count = hit_count + cache_stats.get(f'{cache_name}_MISSES', {}).get('count', 0)
+            if lookup_count:
+                hit_rates[cache_name] = (hit_count / lookup_count, lookup_count)
+    return hit_rates